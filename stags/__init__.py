@@ -1 +1 @@
-__all__ = ["compdb", "parser", "query", "storage", "mergedict"]
+__all__ = ["benchmark", "client", "compdb", "instrument", "parser", "query", "storage", "mergedict"]
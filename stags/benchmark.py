@@ -0,0 +1,336 @@
+"""Benchmarks of indexing
+
+`python -m stags.benchmark cursors source.cpp [compiler arguments]` prints
+how many cursors per second parse_cursor records.
+
+`python -m stags.benchmark project [--sources N ...] [--output report.json]`
+generates a CMake project, times scanning, parsing, merging, storing and
+each query over it and writes a JSON report.
+
+`python -m stags.benchmark compare old.json new.json` prints the ratio of
+each timing between two reports.
+"""
+
+from common import *
+from mergedict import merge_recurse_inplace
+from project import Project, apply_parse
+from query import NAME_QUERIES, Query, query, query_batch, query_class_hierarchy
+from storage import SqliteStorage
+import argparse
+import clang.cindex
+import json
+import os
+import parser
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+def collect_cursors(filename, args, basedir):
+    "Return (cursor, file name) of each cursor parse() would record"
+    tu = clang.cindex.Index.create().parse(filename, args)
+    def get_file_name(cursor):
+        f = cursor.location.file
+        return f and parser.normalize_path(f.name)
+    def is_pruned(cursor_filename):
+        return not cursor_filename.startswith(basedir)
+    return [(cursor, cursor_filename)
+            for cursor, cursor_filename in parser.walk(tu.cursor, get_file_name, is_pruned)
+            if cursor_filename and cursor.kind in parser.kind_allowed]
+
+def cursors_per_second(filename, args, basedir=None, repeat=5):
+    """Return best rate of parse_cursor over cursors of filename
+
+    Cursors are collected again for each run, so that attributes the
+    bindings cache on a cursor are not reused between runs.
+    """
+    filename = os.path.abspath(filename)
+    basedir = basedir or os.path.dirname(filename) + '/'
+    best = None
+    for i in range(repeat):
+        cursors = collect_cursors(filename, args, basedir)
+        parsed_dict = {}
+        begin = time.time()
+        for cursor, cursor_filename in cursors:
+            parser.parse_cursor(cursor, parsed_dict, parser.ref_kind, basedir, cursor_filename)
+        elapsed = time.time() - begin
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(cursors) / best, len(cursors)
+
+# Size of generated project
+DEFAULT_CONFIG = {
+    'sources': 16,      # translation units
+    'headers': 8,       # headers, each included by two translation units or more
+    'depth': 4,         # length of class inheritance chain in each header
+    'templates': 2,     # class templates in each header
+    'functions': 16,    # functions in each translation unit
+}
+
+def generate_header(k, config):
+    lines = ['#pragma once', '']
+    for j in range(config['templates']):
+        lines.append('template <typename T> struct H{}Box{} {{'.format(k, j))
+        lines.append('    T value;')
+        lines.append('    T get() const { return value; }')
+        lines.append('};')
+    for d in range(config['depth']):
+        if d == 0:
+            lines.append('class H{}C0 {{'.format(k))
+            lines.append('  public:')
+            lines.append('    virtual int run(int x) { return x; }')
+            if config['templates']:
+                lines.append('    H{}Box0<int> box;'.format(k))
+        else:
+            lines.append('class H{0}C{1} : public H{0}C{2} {{'.format(k, d, d - 1))
+            lines.append('  public:')
+            lines.append('    int run(int x);')
+        lines.append('};')
+    for d in range(1, config['depth']):
+        body = 'H{}C{}::run(x)'.format(k, d - 1)
+        if config['templates']:
+            body += ' + box.get()'
+        lines.append('inline int H{0}C{1}::run(int x) {{ return {2}; }}'.format(k, d, body))
+    return '\n'.join(lines) + '\n'
+
+def generate_source(n, config):
+    headers = sorted(set([n % config['headers'], (n + 1) % config['headers']]))
+    lines = ['#include "h{}.h"'.format(k) for k in headers]
+    lines.append('')
+    for i in range(config['functions']):
+        k = headers[i % len(headers)]
+        lines.append('int s{}_f{}(int x) {{'.format(n, i))
+        lines.append('    H{}C{} c;'.format(k, config['depth'] - 1))
+        if config['templates']:
+            lines.append('    H{}Box{}<long> b;'.format(k, i % config['templates']))
+            lines.append('    b.value = x;')
+            lines.append('    return c.run(x) + b.get();')
+        else:
+            lines.append('    return c.run(x);')
+        lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+def generate_project(basedir, config):
+    """Write CMake project of config into basedir and return its build directory"""
+    include = os.path.join(basedir, 'include')
+    src = os.path.join(basedir, 'src')
+    for directory in (include, src):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+    for k in range(config['headers']):
+        with open(os.path.join(include, 'h{}.h'.format(k)), 'w') as f:
+            f.write(generate_header(k, config))
+    sources = []
+    for n in range(config['sources']):
+        sources.append('src/s{}.cpp'.format(n))
+        with open(os.path.join(basedir, sources[-1]), 'w') as f:
+            f.write(generate_source(n, config))
+    with open(os.path.join(basedir, 'CMakeLists.txt'), 'w') as f:
+        f.write('cmake_minimum_required(VERSION 2.8)\n'
+                'project(benchmark)\n'
+                'include_directories(include)\n'
+                'add_library(benchmark STATIC {})\n'.format(' '.join(sources)))
+
+    builddir = os.path.join(basedir, 'build')
+    if not os.path.exists(builddir):
+        os.mkdir(builddir)
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['cmake', '-DCMAKE_EXPORT_COMPILE_COMMANDS=1', basedir],
+                              cwd=builddir, stdout=devnull, stderr=devnull)
+    return builddir
+
+def check_project(parsed_dict, config):
+    """Raise RuntimeError unless parsed_dict indexed headers of project of config
+
+    A translation unit whose headers are not found still parses, so
+    timings of a broken parse would be reported without it.
+    """
+    missing = []
+    for k in range(config['headers']):
+        header = 'include/h{}.h'.format(k)
+        if header not in parsed_dict:
+            missing.append(header)
+            continue
+        usr = 'c:@S@H{}C{}'.format(k, config['depth'] - 1)
+        if usr not in parsed_dict or \
+           not parsed_dict[usr].get(DEFI, '').startswith(header + ':'):
+            missing.append(usr)
+        if config['depth'] > 1:
+            root = 'c:@S@H{}C0'.format(k)
+            hierarchy = parsed_dict.get(HIERARCHY, {})
+            if root not in hierarchy or \
+               len(hierarchy[root][DESCENDANTS]) != config['depth'] - 1:
+                missing.append('{} of {}'.format(HIERARCHY, root))
+        if config['templates'] and 'c:@ST>1#T@H{}Box0'.format(k) not in parsed_dict:
+            missing.append('H{}Box0'.format(k))
+    if missing:
+        raise RuntimeError('generated project is not indexed: {}'.format(', '.join(missing)))
+
+def get_headers(parsed_dict):
+    "Return indexed headers of generated project"
+    return sorted(key for key in parser.get_file_keys(parsed_dict)
+                  if key.startswith('include/'))
+
+def timed(timings, name, func, *args, **kwargs):
+    begin = time.time()
+    result = func(*args, **kwargs)
+    timings[name] = time.time() - begin
+    return result
+
+def get_locations(parsed_dict, count, seed=0):
+    "Return up to count locations of parsed_dict sampled with seed"
+    locations = []
+    for key in parser.get_file_keys(parsed_dict):
+        for locus in parsed_dict[key]:
+            locations.append('{}:{}'.format(key, locus))
+    locations.sort()
+    random.Random(seed).shuffle(locations)
+    return locations[:count]
+
+def get_names(parsed_dict, count, seed=0):
+    "Return up to count prefixes of symbol names of parsed_dict sampled with seed"
+    names = sorted(parsed_dict[NAMES].keys()) if NAMES in parsed_dict else []
+    random.Random(seed).shuffle(names)
+    return [name[:3] for name in names[:count]]
+
+def run_query(query_type, location, parsed_dict):
+    if query_type == Query.ClassHierarchy:
+        filename, line, column = location.split(':')
+        return query_class_hierarchy(filename, '{}:{}'.format(line, column),
+                                     parsed_dict, export_as='text')
+    return query(query_type, location, parsed_dict)
+
+def benchmark_project(basedir, config, queries=200):
+    """Generate project of config in basedir, time each stage and return report"""
+    timings = {}
+    builddir = timed(timings, 'generate', generate_project, basedir, config)
+    proj = Project(builddir, basedir)
+
+    sources = timed(timings, 'scan', proj.scan)
+    parsed_dict = timed(timings, 'parse_all', proj.parse_all, sources)
+    check_project(parsed_dict, config)
+
+    results = timed(timings, 'parse_single', lambda: [
+        apply_parse(source, basedir=proj.basedir) for source in sources])
+    def merge_results():
+        merged = {}
+        for result in results:
+            merge_recurse_inplace(merged, result or {})
+        return merged
+    timed(timings, 'merge_recurse_inplace', merge_results)
+
+    dbname = os.path.join(basedir, 'stags.db')
+    def store():
+        storage = SqliteStorage(dbname, 'n')
+        storage.merge(parsed_dict)
+        storage.close()
+    timed(timings, 'storage_write', store)
+
+    storage = SqliteStorage(dbname, 'r')
+    locations = get_locations(storage, queries)
+    names = get_names(storage, queries)
+    for query_type in Query:
+        def run_all():
+            for location in query_type in NAME_QUERIES and names or locations:
+                try:
+                    run_query(query_type, location, storage)
+                except (KeyError, AssertionError):
+                    pass
+        timed(timings, 'query_{}'.format(query_type.name), run_all)
+    requests = [(query_type, location) for query_type in Query
+                if query_type not in NAME_QUERIES and query_type != Query.ClassHierarchy
+                for location in locations]
+    timed(timings, 'query_batch', lambda: list(query_batch(requests, storage)))
+    storage.close()
+
+    return {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': config,
+        'headers': get_headers(parsed_dict),
+        'counts': {
+            'sources': len(sources),
+            'keys': len(parsed_dict),
+            'queries': len(locations),
+            'db_size': os.path.getsize(dbname),
+        },
+        'timings': timings,
+    }
+
+def get_commit():
+    "Return commit of working tree of stags, or None"
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)), stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old, new):
+    "Return lines of each timing of report old and new with their ratio"
+    lines = []
+    for name in sorted(set(old['timings']) | set(new['timings'])):
+        before = old['timings'].get(name, None)
+        after = new['timings'].get(name, None)
+        ratio = before and after is not None and '{:6.2f}x'.format(before / after) or '      -'
+        lines.append('{:32} {:>10} {:>10} {}'.format(
+            name,
+            before is not None and '{:.4f}'.format(before) or '-',
+            after is not None and '{:.4f}'.format(after) or '-',
+            ratio))
+    return lines
+
+def main(argv):
+    argparser = argparse.ArgumentParser(prog='stags.benchmark')
+    subparsers = argparser.add_subparsers(dest='command')
+
+    cursors = subparsers.add_parser('cursors', help='rate of parse_cursor')
+    cursors.add_argument('source')
+    cursors.add_argument('args', nargs=argparse.REMAINDER)
+
+    project = subparsers.add_parser('project', help='benchmark generated project')
+    for key, value in sorted(DEFAULT_CONFIG.items()):
+        project.add_argument('--' + key, type=int, default=value)
+    project.add_argument('--queries', type=int, default=200)
+    project.add_argument('--directory', help='generate project there and keep it')
+    project.add_argument('--output', help='write report there instead of stdout')
+
+    comparison = subparsers.add_parser('compare', help='compare two reports')
+    comparison.add_argument('old')
+    comparison.add_argument('new')
+
+    options = argparser.parse_args(argv)
+    if options.command == 'cursors':
+        rate, count = cursors_per_second(options.source, options.args)
+        print('{} cursors, {:.0f} cursors per second'.format(count, rate))
+    elif options.command == 'project':
+        config = dict((key, getattr(options, key)) for key in DEFAULT_CONFIG)
+        basedir = options.directory or tempfile.mkdtemp(prefix='stags-benchmark-')
+        basedir = os.path.abspath(basedir) + '/'
+        try:
+            report = benchmark_project(basedir, config, options.queries)
+        finally:
+            if not options.directory:
+                shutil.rmtree(basedir)
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options.output:
+            with open(options.output, 'w') as f:
+                f.write(output + '\n')
+        else:
+            print(output)
+    elif options.command == 'compare':
+        with open(options.old) as f:
+            old = json.load(f)
+        with open(options.new) as f:
+            new = json.load(f)
+        for line in compare(old, new):
+            print(line)
+
+if __name__ == '__main__':
+    libclang_set_library_file()
+    main(sys.argv[1:])
@@ -0,0 +1,31 @@
+"""Thin client for query server
+
+Talks to `python -m stags.query stags.db --server socket` without importing
+libclang, so each lookup only pays for a bare interpreter.
+"""
+
+import socket
+import sys
+
+def request(path, query_type, location):
+    """Send one query and return (ok, lines)"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    try:
+        sock.sendall('{} {}\n'.format(query_type, location))
+        sock.shutdown(socket.SHUT_WR)
+        response = sock.makefile('r')
+        status = response.readline().rstrip('\n')
+        if not status.startswith('OK '):
+            return False, [status]
+        count = int(status[len('OK '):])
+        return True, [response.readline().rstrip('\n') for i in range(count)]
+    finally:
+        sock.close()
+
+if __name__ == '__main__':
+    assert len(sys.argv) >= 4
+    ok, lines = request(sys.argv[1], sys.argv[2], sys.argv[3])
+    for line in lines:
+        print(line)
+    sys.exit(0 if ok else 1)
@@ -13,8 +13,50 @@ BASE_CLASS, CHILD_CLASS = (
     'base_class', 'child_class'
 )
 
+# Methods a virtual method overrides directly and methods overriding it
+OVERRIDES, OVERRIDDEN_BY = (
+    'overrides', 'overridden_by'
+)
+
+# Transitive BASE_CLASS and CHILD_CLASS of each class, and OVERRIDES and
+# OVERRIDDEN_BY of each method, in HIERARCHY
+ANCESTORS, DESCENDANTS = (
+    'ancestors', 'descendants'
+)
+HIERARCHY = 'hierarchy'
+
 FILES = 'files'
 
+# USRs each file contributed to, keyed like locus tables
+FILE_USRS = 'file_usrs'
+
+# USRs declared or defined with each spelling
+NAMES = 'names'
+
+# Counter incremented by each write of NAMES, so that readers keeping
+# what they derived from NAMES know when to derive it again
+GENERATION = 'generation'
+
+# Declarations and definitions of each file as sorted (line, column, kind,
+# spelling), keyed like locus tables
+OUTLINES = 'outlines'
+
+# Tokens of declarations and references of each file as sorted (line, first
+# column, column after last), keyed like locus tables
+SPANS = 'spans'
+
+# Keys of sorted lists by file, which are merged from translation units
+SORTED_FILE_TABLES = (OUTLINES, SPANS)
+
+# Record of each file in FILES
+STATE, PARSE_TIME, INCLUDES, PROFILE = (
+    'state', 'parse_time', 'includes', 'profile'
+)
+
+def is_usr(key):
+    "Return True if key of parsed dict is a USR rather than a file"
+    return key.startswith('c:')
+
 def libclang_set_library_file():
     # Higher version first
     LIBCLANG_VERSIONS_SUPPORTED = (3.5, 3.4)
@@ -3,10 +3,17 @@
 """
 
 import clang.cindex
+import json
 import logging
 import os
+import shlex
 import sys
 
+COMPILE_COMMANDS = 'compile_commands.json'
+
+# Characters between elements of JSON array
+SEPARATORS = ' \t\r\n,'
+
 # generator
 def compile_commands(dirname):
     assert(dirname and os.path.isdir(dirname))
@@ -22,6 +29,87 @@ def get_all_compile_commands(dirname):
         for cmd in cmds:
             yield (cmd.directory, ' '.join([arg for arg in cmd.arguments]))
 
+class FlagSets(object):
+    """Registry of distinct argument lists
+
+    intern returns one tuple for all equal argument lists, so translation
+    units compiled alike share their arguments and can be grouped by them.
+    """
+
+    def __init__(self):
+        self.flag_sets = {}
+
+    def intern(self, arguments):
+        arguments = tuple(arguments)
+        return self.flag_sets.setdefault(arguments, arguments)
+
+    def __len__(self):
+        return len(self.flag_sets)
+
+def iter_json_array(f, chunk_size=1 << 16):
+    """Yield each object of JSON array in file f reading chunk_size at once
+
+    The whole file is never held in memory, only the object being decoded.
+    """
+    decoder = json.JSONDecoder()
+    buf, pos, eof = '', 0, False
+    started = False
+    while True:
+        while pos < len(buf) and buf[pos] in SEPARATORS:
+            pos += 1
+        if pos < len(buf) and not started:
+            if buf[pos] != '[':
+                raise ValueError('{} is not a JSON array'.format(f.name))
+            started = True
+            pos += 1
+            continue
+        if pos < len(buf) and buf[pos] == ']':
+            return
+        if pos < len(buf):
+            try:
+                obj, pos = decoder.raw_decode(buf, pos)
+                yield obj
+                continue
+            except ValueError:
+                if eof:
+                    raise
+        elif eof:
+            raise ValueError('{} ends before its array'.format(f.name))
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buf, pos = buf[pos:] + chunk, 0
+
+# Characters making shell splitting differ from splitting by whitespace
+SHELL_QUOTES = ('"', "'", '\\')
+
+def split_command(command):
+    "Return arguments of command split as a shell does"
+    if any(quote in command for quote in SHELL_QUOTES):
+        return shlex.split(command)
+    return command.split()
+
+def to_str(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+def get_compile_commands(dirname):
+    """
+    Get an iterable object of each compile command having
+    (directory, absolute source filename, argument list)
+
+    compile_commands.json in dirname is read as a stream. command strings
+    are split as a shell does, so quoted arguments are kept whole.
+    """
+    assert(dirname and os.path.isdir(dirname))
+    with open(os.path.join(dirname, COMPILE_COMMANDS)) as f:
+        for entry in iter_json_array(f):
+            directory = to_str(entry['directory'])
+            if 'arguments' in entry:
+                arguments = [to_str(arg) for arg in entry['arguments']]
+            else:
+                arguments = split_command(to_str(entry['command']))
+            filename = os.path.normpath(os.path.join(directory, to_str(entry['file'])))
+            yield (directory, filename, arguments)
+
 if __name__ == '__main__':
     libclang_set_library_file()
     logging.basicConfig(level=logging.INFO)
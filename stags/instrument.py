@@ -0,0 +1,191 @@
+"""Timing and profiling instrumentation
+
+Each phase records how many times it ran, total, min and max time and a
+histogram of durations. Counters record amounts like cursors. Phases can
+be profiled with cProfile. The summary is written as JSON:
+
+    with instrument.phase('merge'):
+        ...
+    instrument.count('cursors', n)
+    instrument.write_summary('stats.json')
+"""
+
+import cProfile
+import contextlib
+import json
+import os
+import pstats
+import resource
+import time
+
+# Upper bounds in seconds of histogram buckets, the last is unbounded
+BUCKETS = tuple(0.001 * 2 ** i for i in range(16))
+
+class Phase(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.maxrss_kb = 0
+        self.histogram = [0] * (len(BUCKETS) + 1)
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        self.min = elapsed if self.min is None else min(self.min, elapsed)
+        self.max = elapsed if self.max is None else max(self.max, elapsed)
+        index = len(BUCKETS)
+        for i, bound in enumerate(BUCKETS):
+            if elapsed <= bound:
+                index = i
+                break
+        self.histogram[index] += 1
+
+    def update(self, other):
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+        self.maxrss_kb = max(self.maxrss_kb, other.maxrss_kb)
+        self.histogram = [a + b for a, b in zip(self.histogram, other.histogram)]
+
+    def summary(self):
+        histogram = {}
+        for i, n in enumerate(self.histogram):
+            if n:
+                bound = i < len(BUCKETS) and '<={:g}'.format(BUCKETS[i]) or '>{:g}'.format(BUCKETS[-1])
+                histogram[bound] = n
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.count and self.total / self.count,
+            'min': self.min,
+            'max': self.max,
+            'maxrss_kb': self.maxrss_kb,
+            'histogram': histogram,
+        }
+
+class Stats(object):
+    """Phases and counters of a process
+
+    Stats of worker processes are sent to the parent and merged with update.
+    profile_stats has profile data of phases profiled in workers, see
+    collect_profiles.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.counters = {}
+        self.profile_stats = {}
+
+    def add(self, name, elapsed):
+        if name not in self.phases:
+            self.phases[name] = Phase()
+        self.phases[name].add(elapsed)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def update(self, other):
+        for name, phase in other.phases.iteritems():
+            self.phases.setdefault(name, Phase()).update(phase)
+        for name, n in other.counters.iteritems():
+            self.count(name, n)
+        for name, profile_stats in other.profile_stats.iteritems():
+            self.profile_stats.setdefault(name, []).extend(profile_stats)
+
+    def summary(self):
+        return {
+            'phases': dict((name, phase.summary()) for name, phase in self.phases.iteritems()),
+            'counters': dict(self.counters),
+        }
+
+class ProfileData(object):
+    "Profile data of another process, loaded by pstats as a profile"
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+stats = Stats()
+
+# Names of profiled phases and their profiles
+profiled = set()
+profiles = {}
+
+def reset():
+    "Start new stats, as in a worker process forked with stats of its parent"
+    global stats
+    stats = Stats()
+    profiles.clear()
+
+def configure(profile=()):
+    "Profile phases named in profile with cProfile"
+    profiled.clear()
+    profiled.update(profile)
+
+def collect_profiles():
+    """Move profile data of this process into stats
+
+    A worker process calls it before sending its stats to the parent, which
+    writes them with its own.
+    """
+    for name, profile in profiles.iteritems():
+        profile.create_stats()
+        if profile.stats:
+            stats.profile_stats.setdefault(name, []).append(profile.stats)
+    profiles.clear()
+
+def add(name, elapsed):
+    "Record a phase name measured by caller"
+    stats.add(name, elapsed)
+
+def count(name, n=1):
+    stats.count(name, n)
+
+@contextlib.contextmanager
+def phase(name):
+    "Measure the block as phase name"
+    profile = None
+    if name in profiled:
+        profile = profiles.setdefault(name, cProfile.Profile())
+        profile.enable()
+    begin = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - begin
+        if profile:
+            profile.disable()
+        stats.add(name, elapsed)
+        # kilobytes on Linux
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        stats.phases[name].maxrss_kb = max(stats.phases[name].maxrss_kb, maxrss)
+
+def summary():
+    return stats.summary()
+
+def write_summary(filename):
+    """Write summary as JSON to filename
+
+    Profiles are written next to it as <filename without extension>.<phase>.prof,
+    those of this process and of workers of a phase together.
+    """
+    with open(filename, 'w') as f:
+        json.dump(summary(), f, indent=2, sort_keys=True)
+        f.write('\n')
+    base = os.path.splitext(filename)[0]
+    for name in set(profiles) | set(stats.profile_stats):
+        data = list(stats.profile_stats.get(name, ()))
+        if name in profiles:
+            profiles[name].create_stats()
+            data.append(profiles[name].stats)
+        # pstats empties what it loads
+        data = [ProfileData(dict(profile_stats)) for profile_stats in data if profile_stats]
+        if data:
+            pstats.Stats(*data).dump_stats('{}.{}.prof'.format(base, name))
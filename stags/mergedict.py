@@ -6,6 +6,59 @@ from common import *
 import pprint
 import util
 
+class RefList(list):
+    """ List with hashed membership keeping insertion order of unique values
+
+    Grow it by append/extend and shrink it by remove/difference_update to
+    keep membership in sync. It is pickled as plain list, so neither storage
+    nor multiprocessing needs to know about it.
+    """
+
+    def __init__(self, values=()):
+        list.__init__(self)
+        self.members = set()
+        self.extend(values)
+
+    def __contains__(self, value):
+        return value in self.members
+
+    def append(self, value):
+        if value not in self.members:
+            self.members.add(value)
+            list.append(self, value)
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def remove(self, value):
+        list.remove(self, value)
+        self.members.discard(value)
+
+    def difference_update(self, values):
+        values = set(values)
+        self[:] = [value for value in self if value not in values]
+        self.members.difference_update(values)
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+def merge_list_inplace(l1, l2):
+    """ Append values of l2 not in l1 to l1 and return l1
+
+    l1 is converted to RefList once, so merging into it again costs
+    len(l2) instead of len(l1) * len(l2).
+    """
+
+    if not isinstance(l1, RefList):
+        l1 = RefList(l1)
+    l1.extend(l2)
+    return l1
+
 def merge_recurse_inplace(d1, d2, clstype=None):
     """ Merge small dict to large dict recursive manner
 
@@ -18,16 +71,26 @@ def merge_recurse_inplace(d1, d2, clstype=None):
                 if isinstance(d1[key], dict) and isinstance(d2[key], dict):
                     merge_recurse_inplace(d1[key], d2[key], clstype)
                 elif isinstance(d1[key], list) and isinstance(d2[key], list):
-                    for value in d2[key]:
-                        if not value in d1[key]:
-                            d1[key].append(value)
+                    d1[key] = merge_list_inplace(d1[key], d2[key])
                 else:
                     d1[key] = d2[key]
             else:
                 d1[key] = d2[key]
     elif isinstance(d1, list) and isinstance(d2, list):
+        members = set(d1)
         for value in d2:
-            if not value in d1:
+            if not value in members:
+                members.add(value)
                 d1.append(value)
     else:
         assert False
+
+def merge(d1, d2):
+    """ Merge d2 into d1 which is either dict or storage having merge()
+
+    """
+
+    if isinstance(d1, dict):
+        merge_recurse_inplace(d1, d2)
+    else:
+        d1.merge(d2)
@@ -6,8 +6,13 @@ from clang.cindex import CursorKind
 from common import *
 from mergedict import merge_recurse_inplace
 import clang.cindex
+import collections
+import ctypes
+import hashlib
+import instrument
 import logging
 import os
+import re
 import sys
 
 function_kind = (
@@ -27,6 +32,29 @@ ref_kind = (CursorKind.DECL_REF_EXPR,
 
 kind_allowed = ref_kind + function_kind
 
+# Paths not indexed even if under basedir
+EXCLUDED_PATHS = ('/usr/include/c++',)
+
+# Parse profiles and their libclang parse options
+FULL, DECLARATIONS = ('full', 'declarations')
+PARSE_PROFILES = {
+    FULL: 0,
+    # declarations and class hierarchy of a file parsed on its own
+    DECLARATIONS: clang.cindex.TranslationUnit.PARSE_SKIP_FUNCTION_BODIES |
+                  clang.cindex.TranslationUnit.PARSE_INCOMPLETE,
+}
+
+# Directives of a source changing how files it includes next are preprocessed
+MACRO_DIRECTIVE = re.compile(r'^[ \t]*#[ \t]*(?:define|undef)\b.*$', re.M)
+
+# Index shared by translation units parsed in the process which created it
+index = None
+index_pid = None
+
+# Translation units kept for reparse, least recently used first
+translation_units = collections.OrderedDict()
+TRANSLATION_UNITS_MAX = 16
+
 def normalize_path(p):
     return os.path.abspath(p)
 
@@ -66,13 +94,13 @@ def make_sure_file_locus(parsed_dict, filename, locus):
     p[filename][locus].setdefault(REFS, [])
     return p[filename][locus]
 
-def handle_class_hierarchy(cursor, parsed_dict):
+def handle_class_hierarchy(cursor, parsed_dict, usr=None):
     if cursor.kind != CursorKind.CLASS_DECL:
         return False
 
     p = parsed_dict
     c = cursor
-    usr = c.get_usr()
+    usr = usr or c.get_usr()
 
     def each_inheritance_relation(cursor):
         for base in cursor.get_children():
@@ -96,115 +124,146 @@ def handle_class_hierarchy(cursor, parsed_dict):
     p[usr][BASE_CLASS].extend(bases)
     return True
 
-def is_ref_is_function_template(cursor, parsed_dict, basedir):
-    c = cursor
+def get_overridden_usrs(cursor):
+    "Return USRs of methods which method cursor overrides directly"
+    lib = clang.cindex.conf.lib
+    if lib.clang_getOverriddenCursors.argtypes is None:
+        lib.clang_getOverriddenCursors.argtypes = [
+            clang.cindex.Cursor,
+            ctypes.POINTER(ctypes.POINTER(clang.cindex.Cursor)),
+            ctypes.POINTER(ctypes.c_uint)]
+        lib.clang_getOverriddenCursors.restype = None
+        lib.clang_disposeOverriddenCursors.argtypes = [ctypes.POINTER(clang.cindex.Cursor)]
+        lib.clang_disposeOverriddenCursors.restype = None
+
+    overridden = ctypes.POINTER(clang.cindex.Cursor)()
+    count = ctypes.c_uint()
+    lib.clang_getOverriddenCursors(cursor, ctypes.byref(overridden), ctypes.byref(count))
+    try:
+        # cursors are read before they are disposed of
+        return [usr for usr in (overridden[i].get_usr() for i in range(count.value)) if usr]
+    finally:
+        if count.value:
+            lib.clang_disposeOverriddenCursors(overridden)
+
+def handle_overrides(cursor, parsed_dict, usr):
+    """Record methods which method cursor of usr overrides
+
+    Override relations are taken from libclang rather than matched by
+    USR, so overriding methods of other signatures, such as covariant
+    return types, are related too.
+    """
     p = parsed_dict
+    overridden = get_overridden_usrs(cursor)
+    if not overridden:
+        return False
 
-    result = False
-
-    if c.kind == CursorKind.MEMBER_REF_EXPR:
-        ref_location = c.referenced.location
-        ref_locus = get_locus(ref_location)
-
-        filename = ref_location.file.name
-        basename = filename
-        if basedir:
-            idx = filename.find(basedir)
-            if idx != -1:
-                basename = filename[(idx + len(basedir)):]
+    for base_usr in overridden:
+        p.setdefault(base_usr, {})
+        p[base_usr].setdefault(OVERRIDDEN_BY, [])
+        if usr not in p[base_usr][OVERRIDDEN_BY]:
+            p[base_usr][OVERRIDDEN_BY].append(usr)
 
-        if basename in p and \
-           ref_locus in p[basename]:
-            ref_usr = p[basename][ref_locus][USR]
-            if p[ref_usr][KIND] == CursorKind.FUNCTION_TEMPLATE.name:
-                return True
-    return result
+    overrides = p[usr].setdefault(OVERRIDES, [])
+    overrides.extend(x for x in overridden if x not in overrides)
+    return True
 
-def get_function_template_usr(cursor, parsed_dict, basedir):
-    c = cursor
-    p = parsed_dict
+def get_specialized_template(cursor):
+    "Return template which cursor is specialization of, or None"
+    return clang.cindex.conf.lib.clang_getSpecializedCursorTemplate(cursor)
 
-    assert(c.kind == CursorKind.MEMBER_REF_EXPR)
+def get_function_template(kind, referenced):
+    """Return function template referenced by a cursor of kind, or None
 
-    ref_location = c.referenced.location
-    ref_locus = get_locus(ref_location)
+    libclang is asked instead of looking up parsed_dict, the template may be
+    in a header indexed by another translation unit.
+    """
+    if kind == CursorKind.MEMBER_REF_EXPR:
+        template = get_specialized_template(referenced)
+        if template and template.kind == CursorKind.FUNCTION_TEMPLATE:
+            return template
+    return None
 
+def get_basename(filename, basedir):
+    "Return filename relative to basedir"
     if basedir:
-        filename = ref_location.file.name
         idx = filename.find(basedir)
         if idx != -1:
-            basename = filename[(idx + len(basedir)):]
+            return filename[(idx + len(basedir)):]
+    return filename
+
+def add_span(parsed_dict, basename, location, spelling):
+    "Record token of spelling at location in SPANS"
+    column = location.column
+    parsed_dict.setdefault(SPANS, {}).setdefault(basename, []).append(
+        (location.line, column, column + max(len(spelling), 1)))
 
-    assert(not os.path.isabs(basename))
-    ref_usr = p[basename][ref_locus][USR]
-    assert(ref_usr)
-    return ref_usr
+def parse_cursor(cursor, parsed_dict, ref_kind, basedir, filename=None, basename=None):
+    """Record declaration or reference of cursor in parsed_dict
 
-def parse_cursor(cursor, parsed_dict, ref_kind, basedir):
+    Each attribute of cursor is fetched from libclang once. filename and
+    basename of the file of cursor may be given by the caller caching them.
+    """
     c = cursor
     p = parsed_dict
 
-    filename = normalize_path(c.location.file.name)
-    assert(basedir)
-    basename = filename
-    if basedir:
-        idx = filename.find(basedir)
-        if idx != -1:
-            basename = filename[(idx + len(basedir)):]
+    kind = c.kind
+    if kind not in ref_kind and kind not in function_kind:
+        return
 
-    locus = get_locus(c.location)
-    usr = c.get_usr()
+    assert(basedir)
+    if basename is None:
+        basename = get_basename(filename or normalize_path(c.location.file.name), basedir)
+    assert(not basename.startswith(basedir))
 
+    location = c.location
+    locus = get_locus(location)
     filename_locus = get_filename_locus(basename, locus)
 
-    if c.kind in ref_kind:
-        assert not c.get_usr()
-        p.setdefault(basename, {})
-        assert(not basename.startswith(basedir))
-        file_dict = p[basename]
-        assert c.location.line and c.location.column
-        is_definition = c.is_definition()
-        if c.referenced and c.referenced.get_usr():
-            assert c.referenced.get_usr()
+    if kind in ref_kind:
+        file_dict = p.setdefault(basename, {})
+        referenced = c.referenced
+        r_usr = referenced and referenced.get_usr()
+        if r_usr:
+            add_span(p, basename, location, referenced.spelling)
             entry = {}
-            if c.kind == CursorKind.TEMPLATE_REF and \
-               c.referenced.kind == CursorKind.CLASS_TEMPLATE:
-                entry[TEMPLATE_USR] = c.referenced.get_usr()
-            elif is_ref_is_function_template(c, p, basedir):
-                entry[TEMPLATE_USR] = get_function_template_usr(c, p, basedir)
+            if kind == CursorKind.TEMPLATE_REF and \
+               referenced.kind == CursorKind.CLASS_TEMPLATE:
+                entry[TEMPLATE_USR] = r_usr
             else:
-                entry[REF_USR] = c.referenced.get_usr()
+                template = get_function_template(kind, referenced)
+                if template:
+                    r_usr = template.get_usr()
+                    assert(r_usr)
+                    entry[TEMPLATE_USR] = r_usr
+                else:
+                    entry[REF_USR] = r_usr
             if locus in file_dict:
                 merge_recurse_inplace(file_dict[locus], entry)
             else:
                 file_dict[locus] = entry
 
             # update reference in usr
-            r = c.referenced
-            r_usr = r.get_usr()
-            if TEMPLATE_USR in entry:
-                r_usr = entry[TEMPLATE_USR]
-
-            p.setdefault(usr, {})
-            filename_locus = get_filename_locus(basename, locus)
             entry = {
                 REFS: [filename_locus]
             }
-            if c.kind == CursorKind.CXX_BASE_SPECIFIER:
-                entry[KIND] = c.kind.name
+            if kind == CursorKind.CXX_BASE_SPECIFIER:
+                entry[KIND] = kind.name
                 entry[SPELL] = c.spelling
 
             if r_usr in p:
                 merge_recurse_inplace(p[r_usr], entry)
             else:
                 p[r_usr] = entry
+        return
 
-    if c.kind in function_kind:
-        # assert usr
+    usr = c.get_usr()
+    if usr:
+        spell = c.spelling
         entry = {
             c.is_definition() and DEFI or DECL: filename_locus,
-            KIND: c.kind.name,
-            SPELL: c.spelling,
+            KIND: kind.name,
+            SPELL: spell,
             TYPE: c.type.kind.name,
             REFS: [],
         }
@@ -213,9 +272,15 @@ def parse_cursor(cursor, parsed_dict, ref_kind, basedir):
         else:
             p[usr] = entry
 
-        p.setdefault(basename, {})
-        assert(not basename.startswith(basedir))
-        file_dict = p[basename]
+        usrs = p.setdefault(NAMES, {}).setdefault(spell, [])
+        if usr not in usrs:
+            usrs.append(usr)
+
+        p.setdefault(OUTLINES, {}).setdefault(basename, []).append(
+            (location.line, location.column, kind.name, spell))
+        add_span(p, basename, location, spell)
+
+        file_dict = p.setdefault(basename, {})
         locus_entry = {
             USR: usr
         }
@@ -224,83 +289,416 @@ def parse_cursor(cursor, parsed_dict, ref_kind, basedir):
         else:
             file_dict[locus] = locus_entry
 
-        result = handle_class_hierarchy(c, p)
+        if kind == CursorKind.CLASS_DECL:
+            handle_class_hierarchy(c, p, usr)
+        elif kind == CursorKind.CXX_METHOD and c.is_virtual_method():
+            handle_overrides(c, p, usr)
+
+def walk(cursor, get_file_name, is_pruned):
+    """Yield (descendant, its file name) of cursor in preorder
+
+    A cursor whose file name is_pruned is not yielded and its children are
+    not visited, so subtrees of system and skipped headers are not walked.
+    """
+    stack = list(cursor.get_children())
+    stack.reverse()
+    while stack:
+        c = stack.pop()
+        cursor_filename = get_file_name(c)
+        if cursor_filename and is_pruned(cursor_filename):
+            continue
+        yield c, cursor_filename
+        children = list(c.get_children())
+        children.reverse()
+        stack.extend(children)
+
+def get_context(args):
+    "Return hash of arguments which may change the result of preprocessing"
+    return hashlib.md5('\0'.join(args)).hexdigest()
+
+def get_macro_directives(filename):
+    "Return (line, text) of each #define and #undef of filename"
+    try:
+        with open(filename) as f:
+            content = f.read()
+    except IOError:
+        return []
+    directives = []
+    line = 1
+    position = 0
+    for match in MACRO_DIRECTIVE.finditer(content):
+        line += content.count('\n', position, match.start())
+        position = match.start()
+        directives.append((line, match.group(0).strip()))
+    return directives
+
+def get_inclusion_lines(filename, inclusions):
+    """Return dict of each included file to the first line of filename including it
+
+    inclusions are (including file, included file, line) and the line is
+    found for files included indirectly too.
+    """
+    lines = {}
+    changed = True
+    while changed:
+        changed = False
+        for source, included, line in inclusions:
+            if source != filename:
+                line = lines.get(source, None)
+            if line is not None and line < lines.get(included, line + 1):
+                lines[included] = line
+                changed = True
+    return lines
+
+def get_index():
+    "Return libclang Index of this process, created once per process"
+    global index, index_pid
+    if index is None or index_pid != os.getpid():
+        index = clang.cindex.Index.create()
+        index_pid = os.getpid()
+    return index
+
+def parse_translation_unit(filename, args, reparse=False, options=0):
+    """Return translation unit of filename parsed with args and options
+
+    With reparse, the translation unit is kept with a precompiled preamble
+    and the next parse of filename with the same args reparses it, so that
+    unchanged headers included at the top of filename are not parsed again.
+    """
+    if not reparse:
+        return get_index().parse(filename, args, options=options)
+
+    key = (filename, get_context(args), options)
+    tu = translation_units.pop(key, None)
+    if tu is None:
+        tu = get_index().parse(
+            filename, args,
+            options=options | clang.cindex.TranslationUnit.PARSE_PRECOMPILED_PREAMBLE)
+    else:
+        tu.reparse()
+    translation_units[key] = tu
+    while len(translation_units) > TRANSLATION_UNITS_MAX:
+        translation_units.popitem(last=False)
+    return tu
 
 def parse(filename, *args, **kwargs):
-    index = clang.cindex.Index.create()
-
+    """Parse filename with compiler arguments args
+
+    indexed_files, if given, is a mapping shared by translation units
+    parsed with the same one. Each file is claimed there by the first
+    translation unit seeing it with its context, and others skip it. The
+    context is args, profile and the macros filename defines or undefines
+    before including the file.
+    reparse keeps the translation unit to be reparsed next time, see
+    parse_translation_unit. profile is one of PARSE_PROFILES, FULL by
+    default.
+    """
     parsed_dict = {}
 
     filename = os.path.abspath(filename)
     basedir = kwargs.get('basedir', None)
+    profile = kwargs.get('profile', None) or FULL
+
+    indexed_files = kwargs.get('indexed_files', None)
+    skipped = {}
+
+    def is_skipped(cursor_filename):
+        if indexed_files is None:
+            return False
+        if cursor_filename not in skipped:
+            # files indexed without function bodies are indexed again in
+            # full, and files included after macros filename defines are
+            # indexed again with those
+            line = inclusion_lines.get(cursor_filename, sys.maxint)
+            context = get_context(args + (profile,) + tuple(
+                text for directive_line, text in macro_directives if directive_line < line))
+            key = '{}:{}'.format(cursor_filename, context)
+            owner = indexed_files.setdefault(key, filename)
+            skipped[cursor_filename] = owner != filename
+        return skipped[cursor_filename]
 
     try:
-        tu = index.parse(filename, args)
+        tu = parse_translation_unit(filename, args, kwargs.get('reparse', False),
+                                    PARSE_PROFILES[profile])
     except clang.cindex.TranslationUnitLoadError as e:
         logging.warning(e)
         return
 
+    # record project files included to detect their change later
+    parsed_dict[FILES] = {}
+    inclusions = []
+    for inclusion in tu.get_includes():
+        included = normalize_path(inclusion.include.name)
+        if not basedir or included.startswith(basedir):
+            parsed_dict[FILES][included] = {}
+        if inclusion.source:
+            inclusions.append((normalize_path(inclusion.source.name), included,
+                               inclusion.location.line))
+
+    macro_directives = []
+    inclusion_lines = {}
+    if indexed_files is not None:
+        macro_directives = get_macro_directives(filename)
+        inclusion_lines = get_inclusion_lines(filename, inclusions)
+
     debug = kwargs.get('debug', False)
 
-    for cursor in tu.cursor.walk_preorder():
+    file_names = {}
+    def get_file_name(cursor):
+        "Return normalized name of file of cursor, looked up once per CXFile"
+        f = cursor.location.file
+        if f is None:
+            return None
+        key = ctypes.cast(f.obj, ctypes.c_void_p).value
+        if key not in file_names:
+            file_names[key] = normalize_path(f.name)
+        return file_names[key]
+
+    pruned = {}
+    def is_pruned(cursor_filename):
+        if cursor_filename not in pruned:
+            pruned[cursor_filename] = (
+                cursor_filename.startswith(EXCLUDED_PATHS) or
+                (basedir and not cursor_filename.startswith(basedir)) or
+                is_skipped(cursor_filename))
+        return pruned[cursor_filename]
+
+    basenames = {}
+    cursors = 0
+    for cursor, cursor_filename in walk(tu.cursor, get_file_name, is_pruned):
+        cursors += 1
         if cursor.kind in kind_allowed:
-            if not cursor.location.file:
+            if not cursor_filename:
                 logging.debug('Cursor without location {}: {}'.format(
                     filename, cursor_to_string(cursor, ref_kind)))
             else:
-                cursor_filename = os.path.normpath(cursor.location.file.name)
-                if cursor_filename.startswith('/usr/include/c++'):
-                    continue
-
-                parse_cursor(cursor, parsed_dict, ref_kind, basedir)
+                if cursor_filename not in basenames:
+                    basenames[cursor_filename] = get_basename(cursor_filename, basedir)
+                parse_cursor(cursor, parsed_dict, ref_kind, basedir,
+                             cursor_filename, basenames[cursor_filename])
         if debug:
             logging.info(cursor_to_string(cursor, ref_kind))
+    instrument.count('cursors', cursors)
+
+    parsed_dict[FILE_USRS] = {}
+    for key in get_file_keys(parsed_dict):
+        parsed_dict[FILE_USRS][key] = get_file_usrs(parsed_dict[key])
+    for key in SORTED_FILE_TABLES:
+        parsed_dict.setdefault(key, {})
+    sort_file_tables(parsed_dict, get_file_keys(parsed_dict))
 
     return parsed_dict
 
-def remove(parsed_dict, filename):
-    logging.info('remove(parsed_dict, {})'.format(filename))
+def get_file_keys(parsed_dict):
+    "Return keys of per file locus tables in parsed_dict"
+    return [key for key in parsed_dict
+            if key not in (FILES, FILE_USRS, NAMES, GENERATION, HIERARCHY, 'basedir') +
+            SORTED_FILE_TABLES
+            and not is_usr(key)]
+
+def get_file_usrs(file_dict):
+    "Return USRs declared, defined or referenced in locus table file_dict"
+    usrs = set()
+    for entry in file_dict.values():
+        for key in (USR, REF_USR, TEMPLATE_USR):
+            if key in entry:
+                usrs.add(entry[key])
+    return sorted(usrs)
+
+def remove(parsed_dict, filename, touched=None):
+    """Remove locus table of filename and what it contributed to USRs
+
+    USRs to update are looked up in FILE_USRS, so only entries filename
+    contributed to are read. USR entries left without declaration,
+    definition, reference and class relation are removed too, so that
+    reparsing does not grow parsed_dict. Classes and methods whose
+    relations changed are added to touched, if given, for update_hierarchy.
+    """
     p = parsed_dict
-    logging.info('parsed_dict[{}] : {}'.format(filename, p[filename]))
-    for locus in p[filename]:
-        logging.info('# Removing {} in {}'.format(locus, filename))
-        entry = p[filename][locus]
-        logging.debug('p[{}][{}]'.format(filename, locus))
-        if USR in entry:
-            key = entry[USR]
-            value = p[key]
-            filename_locus = get_filename_locus(filename, locus)
-            # logging.debug('## Has USR: {}'.format(value))
-
-            removed = False
-            if DECL in value:
-                if filename_locus == value[DECL]:
-                    logging.debug('## Del ref[{}]'.format(DECL))
-                    del value[DECL]
-                    p[entry[USR]] = value
-                    removed = DECL
-            if DEFI in value:
-                if filename_locus == value[DEFI]:
-                    logging.debug('## Del ref[{}]'.format(DEFI))
-                    del value[DEFI]
-                    p[entry[USR]] = value
-                    removed = DEFI
-            assert removed in (DECL, DEFI)
-        elif REF_USR in entry:
-            key = entry[REF_USR]
-            value = p[key]
-            # logging.debug('## Has REF_USR: {}'.format(value))
-            filename_locus = get_filename_locus(filename, locus)
-
-            assert filename_locus in value[REFS]
-            refs = value[REFS]
-            refs = [item for item in refs if item != filename_locus]
-            p[key] = value
-            assert filename_locus not in refs
-        else:
-            assert False
+    if not filename in p:
+        return
+    logging.debug('remove(parsed_dict, {})'.format(filename))
+
+    file_usrs = None
+    if FILE_USRS in p:
+        file_usrs_dict = p[FILE_USRS]
+        if filename in file_usrs_dict:
+            file_usrs = file_usrs_dict[filename]
+            del file_usrs_dict[filename]
+            p[FILE_USRS] = file_usrs_dict
+    if file_usrs is None:
+        # written before FILE_USRS was recorded
+        file_usrs = get_file_usrs(p[filename])
     del p[filename]
 
+    for key in SORTED_FILE_TABLES:
+        if key in p:
+            table = p[key]
+            if filename in table:
+                del table[filename]
+                p[key] = table
+
+    prefix = filename + ':'
+    removed_names = {}
+    def is_removed(filename_locus):
+        return filename_locus is not None and filename_locus.startswith(prefix)
+
+    def unlink(usr, value, key, inverse):
+        "Remove relation key of usr and usr from inverse of its relatives"
+        for relative in value[key]:
+            if relative in p and inverse in p[relative]:
+                relative_value = p[relative]
+                relative_value[inverse] = [x for x in relative_value[inverse] if x != usr]
+                p[relative] = relative_value
+        if touched is not None:
+            touched.add(usr)
+            touched.update(value[key])
+        del value[key]
+
+    for usr in file_usrs:
+        if not usr in p:
+            continue
+        value = p[usr]
+        if is_removed(value.get(DEFI, None)) and BASE_CLASS in value:
+            unlink(usr, value, BASE_CLASS, CHILD_CLASS)
+        for key in (DECL, DEFI):
+            if is_removed(value.get(key, None)):
+                del value[key]
+        # overrides are recorded by each declaration and definition
+        if OVERRIDES in value and not (value.get(DECL, None) or value.get(DEFI, None)):
+            unlink(usr, value, OVERRIDES, OVERRIDDEN_BY)
+        has_refs = False
+        if REFS in value:
+            if hasattr(p, 'remove_refs'):
+                # delete the rows of filename instead of rewriting the list
+                has_refs = p.remove_refs(usr, filename)
+            else:
+                refs = value[REFS]
+                kept = [x for x in refs if not is_removed(x)]
+                if len(kept) != len(refs):
+                    value[REFS] = kept
+                has_refs = bool(kept)
+
+        if has_refs or any(value.get(key, None) for key in
+                           (DEFI, DECL, BASE_CLASS, CHILD_CLASS, OVERRIDES, OVERRIDDEN_BY)):
+            p[usr] = value
+        else:
+            if SPELL in value:
+                removed_names.setdefault(value[SPELL], set()).add(usr)
+            if touched is not None and HIERARCHY in p and usr in p[HIERARCHY]:
+                touched.add(usr)
+            del p[usr]
+
+    if removed_names and NAMES in p:
+        names = p[NAMES]
+        for spell, usrs in removed_names.iteritems():
+            if spell in names:
+                kept = [x for x in names[spell] if x not in usrs]
+                if kept:
+                    names[spell] = kept
+                else:
+                    del names[spell]
+        p[NAMES] = names
+        touch_names(p)
+
+def touch_names(parsed_dict):
+    "Increment GENERATION after NAMES of parsed_dict is written"
+    parsed_dict[GENERATION] = parsed_dict.get(GENERATION, 0) + 1
+
+def sort_file_tables(parsed_dict, filenames):
+    """Sort lists of filenames in SORTED_FILE_TABLES again
+
+    A list merged from several translation units has the entries of the
+    later ones appended.
+    """
+    p = parsed_dict
+    if not filenames:
+        return
+    for key in SORTED_FILE_TABLES:
+        if key not in p:
+            continue
+        table = p[key]
+        for filename in filenames:
+            if filename in table:
+                table[filename] = sorted(set(table[filename]))
+        p[key] = table
+
+def get_relations(parsed_dict, usr, relations=None):
+    """Return (bases, children) of class usr, or (overridden, overriding) of method usr
+
+    relations, if given, keeps them for later calls.
+    """
+    if relations is not None and usr in relations:
+        return relations[usr]
+    value = parsed_dict[usr] if usr in parsed_dict else {}
+    result = (value.get(BASE_CLASS, []) + value.get(OVERRIDES, []),
+              value.get(CHILD_CLASS, []) + value.get(OVERRIDDEN_BY, []))
+    if relations is not None:
+        relations[usr] = result
+    return result
+
+def get_closure(parsed_dict, usr, relations=None):
+    """Return sorted (ancestors, descendants) of class or method usr
+
+    They are read from HIERARCHY written by update_hierarchy, or found
+    by walking get_relations in parsed_dict without it.
+    """
+    p = parsed_dict
+    if relations is None:
+        # one entry is read, HIERARCHY may be a table of storage
+        try:
+            closure = p[HIERARCHY][usr]
+        except KeyError:
+            pass
+        else:
+            return closure[ANCESTORS], closure[DESCENDANTS]
+
+    closure = []
+    for direction in (0, 1):
+        found = set()
+        stack = [usr]
+        while stack:
+            for relative in get_relations(p, stack.pop(), relations)[direction]:
+                if relative not in found and relative != usr:
+                    found.add(relative)
+                    stack.append(relative)
+        closure.append(sorted(found))
+    return tuple(closure)
+
+def update_hierarchy(parsed_dict, touched):
+    """Write ANCESTORS and DESCENDANTS of USRs related to touched in HIERARCHY
+
+    Every class connected to a touched class by inheritance, or method
+    connected by overriding, may have gained or lost relatives, so the
+    closures of the whole connected USRs are written again. USRs without
+    relatives are removed from HIERARCHY.
+    """
+    p = parsed_dict
+    if not touched:
+        return
+    relations = {}
+    connected = set()
+    stack = list(touched)
+    while stack:
+        usr = stack.pop()
+        if usr in connected:
+            continue
+        connected.add(usr)
+        bases, children = get_relations(p, usr, relations)
+        stack.extend(bases)
+        stack.extend(children)
+
+    if HIERARCHY not in p:
+        p[HIERARCHY] = {}
+    hierarchy = p[HIERARCHY]
+    for usr in connected:
+        ancestors, descendants = get_closure(p, usr, relations)
+        if ancestors or descendants:
+            hierarchy[usr] = {ANCESTORS: ancestors, DESCENDANTS: descendants}
+        elif usr in hierarchy:
+            del hierarchy[usr]
+    p[HIERARCHY] = hierarchy
+
 if __name__ == '__main__':
     libclang_set_library_file()
     logging.basicConfig(level=logging.INFO)
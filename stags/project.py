@@ -3,22 +3,31 @@
 """
 
 from common import *
-from mergedict import merge_recurse_inplace
-from storage import ShelveStorage as Storage
+from mergedict import merge, merge_recurse_inplace
+from storage import open_storage
 import clang.cindex
 import compdb
+import instrument
 import logging
-import math
 import multiprocessing as mp
 import os
 import parser
 import pprint
-import re
 import sys
 import time
 import util
 
-def parse_one(src, compiler, *args, **kwargs):
+# Summary of instrument written by a parse
+STATS_FILENAME = 'stags.stats.json'
+
+# Number of translation units merged into storage at once
+BATCH_SIZE = 32
+
+# Seconds between scans of the watch action
+WATCH_INTERVAL = 1.0
+
+def parse_one(src, *args, **kwargs):
+    "Parse src with compiler arguments args, which scan gives without the compiler"
     logging.debug('parsing {} with {}'.format(src, args))
     return parser.parse(src, *args, **kwargs)
 
@@ -28,57 +37,202 @@ def apply_parse(args, **kwargs):
     src, others = args
     return parse_one(src, *others, **kwargs)
 
+# Sources scanned from compile commands
+SOURCE_EXTENSIONS = ('.c', '.cpp', '.cc')
+
+# Headers scanned as sources of their own
+HEADER_EXTENSIONS = ('.hpp', '.h')
+
+# Options taking a path, relative to the directory of a compile command
+PATH_OPTIONS = ('-I', '-isystem', '-iquote', '-idirafter', '-include')
+
 class Project:
+    # parse profile of headers scanned on their own, see parser.PARSE_PROFILES
+    header_profile = parser.DECLARATIONS
+
     def __init__(self, builddir, basedir):
         self.builddir = builddir
         self.basedir = basedir
+        self.flag_sets = compdb.FlagSets()
         if not self.basedir.endswith('/'):
             self.basedir += '/'
 
     @util.measure
     def scan(self):
-        sources = []
-        processed = set()
-
-        re_src = re.compile(r'.*/(.*\.(c|cpp|cc))$')
-
-        for directory, arg_string in compdb.get_all_compile_commands(self.builddir):
-            args = arg_string.split()
-            compiler = args[0]
-            arguments = args[1:]
+        """Return (source, arguments) to parse for each compile command
 
-            src = [x for x in arguments if re_src.match(x)]
-            assert(len(src) == 1)
-            src = src[0]
-            others = [x for x in arguments if not re_src.match(x)]
+        Arguments are tuples interned in flag_sets, so sources with identical
+        arguments share them. Sibling headers are found in a listing read
+        once per directory.
+        """
+        sources = []
+        listings = {}
 
-            if src.endswith('.cpp') or src.endswith('.cc'):
+        for directory, src, arguments in compdb.get_compile_commands(self.builddir):
+            base, ext = os.path.splitext(src)
+            if ext not in SOURCE_EXTENSIONS:
+                continue
+            others = self.get_parse_arguments(arguments[1:], src, directory)
+            if ext in ('.cpp', '.cc'):
                 others.extend(['-x' ,'c++'])
+            others = self.flag_sets.intern(others)
 
-            extensions = ('.hpp', '.h')
-            base, ext = os.path.splitext(src)
+            dirname = os.path.dirname(src)
+            if dirname not in listings:
+                listings[dirname] = set(os.listdir(dirname)) if os.path.isdir(dirname) else set()
+            name = os.path.basename(base)
             headers = [(base + ext, others)
-                       for ext in extensions
-                       if os.path.isfile(base + ext)]
+                       for ext in HEADER_EXTENSIONS
+                       if name + ext in listings[dirname]]
             sources.append((src, others))
             sources.extend(headers)
         return sources
 
+    @staticmethod
+    def get_parse_arguments(arguments, src, directory):
+        """Return compiler arguments without src and its output
+
+        Output does not change parsing, so dropping it lets sources
+        compiled alike share their arguments. Paths of PATH_OPTIONS are made
+        absolute, as sources are parsed in another directory.
+        """
+        others = []
+        skip = False
+        path_option = False
+        for arg in arguments:
+            if path_option:
+                path_option = False
+                others.append(os.path.normpath(os.path.join(directory, arg)))
+            elif skip:
+                skip = False
+            elif arg in PATH_OPTIONS:
+                path_option = True
+                others.append(arg)
+            elif arg.startswith('-I') and not os.path.isabs(arg[2:]):
+                others.append(arg[:2] + os.path.normpath(os.path.join(directory, arg[2:])))
+            elif arg == '-o':
+                skip = True
+            elif arg == '-c' or arg.startswith('-o') and len(arg) > 2:
+                pass
+            elif not arg.startswith('-') and \
+                 os.path.normpath(os.path.join(directory, arg)) == src:
+                pass
+            else:
+                others.append(arg)
+        return others
+
+    def get_profile(self, filename):
+        "Return parse profile of source filename"
+        if os.path.splitext(filename)[1] in HEADER_EXTENSIONS:
+            return self.header_profile
+        return parser.FULL
+
+    def has_profile_changed_p(self, files, src):
+        record = files[src]
+        profile = isinstance(record, dict) and record.get(PROFILE, None) or parser.FULL
+        return profile != self.get_profile(src)
+
     def scan_modified(self, scanned_list, files):
+        """Return sources in scanned_list to be parsed again
+
+        Those are new sources, modified sources, sources including a
+        modified file and sources parsed with another profile.
+        """
         if not files or not scanned_list:
             return None
 
+        modified = set(f for f in files if self.has_file_modified_p(files, f))
+        dependents = self.get_dependents(files)
+        for f in list(modified):
+            modified.update(dependents.get(f, ()))
+
         scanned_list_new = []
-        for src, others in scanned_list:
-            if self.has_file_modified_p(files, src):
-                scanned_list_new.append((src, others))
+        for source in scanned_list:
+            src = source[0]
+            if src in modified or not src in files or self.has_profile_changed_p(files, src):
+                scanned_list_new.append(source)
         return scanned_list_new
 
+    @staticmethod
+    def get_writers(files):
+        """Return dict of each file to sources writing it
+
+        A source writes its own tables and those of the files it includes.
+        """
+        writers = {}
+        for src, record in files.iteritems():
+            if isinstance(record, dict) and INCLUDES in record:
+                for written in (src,) + tuple(record[INCLUDES]):
+                    writers.setdefault(written, set()).add(src)
+        return writers
+
+    def get_shared_files(self, files, srcs):
+        """Return keys of files written by a source not in srcs
+
+        A header included with other flags by a source not parsed again
+        keeps what that source wrote, so update merges into those files
+        instead of replacing them. A file which changed itself is replaced
+        anyway. Only sources recorded in files count, see remove_unscanned.
+        """
+        files = dict(files.iteritems()) if files else {}
+        srcs = set(srcs)
+        return set(parser.get_basename(written, self.basedir)
+                   for written, writers in self.get_writers(files).iteritems()
+                   if not writers <= srcs and not self.has_file_modified_p(files, written))
+
+    def remove_unscanned(self, storage, scanned_list):
+        """Remove sources not in scanned_list any more from storage
+
+        Tables and FILES records of those sources and of the files they
+        wrote are removed. Other sources writing one of those files lose
+        their FILES record too, so that scan_modified parses them again
+        as new and the files are written again without the removed ones.
+        """
+        if FILES not in storage:
+            return
+        files = storage[FILES]
+        records = dict(files.iteritems())
+        scanned = set(source[0] for source in scanned_list)
+        removed = set(src for src, record in records.iteritems()
+                      if isinstance(record, dict) and PROFILE in record and src not in scanned)
+        if not removed:
+            return
+        writers = self.get_writers(records)
+        written = set()
+        for src in removed:
+            written.add(src)
+            written.update(records[src].get(INCLUDES, ()))
+        touched = set()
+        with instrument.phase('remove'):
+            for filename in written:
+                parser.remove(storage, parser.get_basename(filename, self.basedir), touched)
+                for src in writers.get(filename, ()) | set([filename]):
+                    if src in files:
+                        del files[src]
+        storage[FILES] = files
+        with instrument.phase('hierarchy'):
+            parser.update_hierarchy(storage, touched)
+
+    @staticmethod
+    def get_dependents(files):
+        """Return dict of each included file to sources including it
+
+        INCLUDES of a source has every file it includes directly or not, so
+        this is the reverse dependency closure.
+        """
+        dependents = {}
+        for src, record in files.iteritems():
+            if isinstance(record, dict):
+                for included in record.get(INCLUDES, ()):
+                    dependents.setdefault(included, set()).add(src)
+        return dependents
+
     @staticmethod
     def get_files_from_db(dbname):
         if os.path.exists(dbname):
-            parsed_dict = Storage(dbname, 'r')
+            parsed_dict = open_storage(dbname, 'r')
             files = parsed_dict.get(FILES, None)
+            files = files and dict(files)
             logging.debug('get_files_from_db: dbname: {}, files: {}'.format(dbname, files))
             parsed_dict.close()
             return files
@@ -87,78 +241,246 @@ class Project:
 
     @staticmethod
     def has_file_modified_p(files, src):
+        """Return True if src is new or its content changed since parsed"""
         if os.path.exists(src):
+            if not src in files:
+                return True
+            record = files[src]
+            if isinstance(record, dict) and STATE in record:
+                return util.file_changed(record[STATE], src)
+            # databases before file state keep parsed time only
             time_file_modified = os.path.getmtime(src)
-            if src in files:
-                logging.debug('has_file_modified_p: {} > {}'.format(time_file_modified, files[src]))
-                if int(time_file_modified) >= int(files[src]):
-                    return True
+            logging.debug('has_file_modified_p: {} > {}'.format(time_file_modified, record))
+            if int(time_file_modified) >= int(record):
+                return True
         return False
 
+    @staticmethod
+    def order_by_cost(sources, files):
+        """Sort sources so that the most expensive is parsed first
+
+        Cost is the parse time recorded in files, or file size scaled by the
+        average parse time per byte of the recorded ones.
+        """
+        files = files or {}
+        sizes = {}
+        times = {}
+        for source in sources:
+            src = source[0]
+            sizes[src] = os.path.exists(src) and os.path.getsize(src) or 0
+            record = files.get(src, None)
+            if isinstance(record, dict) and PARSE_TIME in record:
+                times[src] = record[PARSE_TIME]
+
+        time_per_byte = 1.0
+        known_size = sum(sizes[src] for src in times)
+        if known_size:
+            time_per_byte = sum(times.values()) / known_size
+
+        def cost(source):
+            src = source[0]
+            return times.get(src, sizes[src] * time_per_byte)
+        return sorted(sources, key=cost, reverse=True)
+
+    @staticmethod
+    def fold(batch, states, filename, state, profile, elapsed, result):
+        """Merge result of filename into batch with record of each file
+
+        states caches state of included files during a run. A file which
+        failed to parse, with None as result, is not recorded, so that it
+        is parsed again next time.
+        """
+        if result is None:
+            return
+        included = result.pop(FILES, {})
+        merge_recurse_inplace(batch, result)
+        batch.setdefault(FILES, {})
+        for header in included:
+            if header not in states and os.path.exists(header):
+                states[header] = util.file_state(header)
+            if header in states:
+                batch[FILES].setdefault(header, {})
+                batch[FILES][header][STATE] = states[header]
+        batch[FILES][filename] = {
+            STATE: state,
+            PROFILE: profile,
+            PARSE_TIME: elapsed,
+            INCLUDES: tuple(sorted(included)),
+        }
+
+    @staticmethod
+    def update(storage, batch, refreshed, touched, basedir=None):
+        """Replace what files of batch contributed to storage and merge batch
+
+        Locus tables and symbol entries left from a previous parse of a file
+        are removed the first time the file appears in a run, which refreshed
+        records, so that removed or moved symbols do not linger in storage.
+        Sources parsed in batch, named relative to basedir, are removed too
+        even if they have no table left. Files already in refreshed are
+        merged into, see get_shared_files. Outlines and spans merged from
+        several translation units are sorted again. Classes and methods
+        whose relations changed are added to touched.
+        """
+        filenames = parser.get_file_keys(batch)
+        parsed = []
+        if basedir:
+            parsed = [parser.get_basename(src, basedir)
+                      for src, record in batch.get(FILES, {}).iteritems() if PROFILE in record]
+        merged_again = []
+        with instrument.phase('remove'):
+            for filename in filenames + [x for x in parsed if x not in filenames]:
+                if filename in refreshed:
+                    if filename in filenames:
+                        merged_again.append(filename)
+                else:
+                    refreshed.add(filename)
+                    parser.remove(storage, filename, touched)
+        for key, value in batch.iteritems():
+            if is_usr(key) and any(relation in value for relation in
+                                   (BASE_CLASS, CHILD_CLASS, OVERRIDES, OVERRIDDEN_BY)):
+                touched.add(key)
+        with instrument.phase('merge'):
+            parser.sort_file_tables(batch, filenames)
+            merge(storage, batch)
+            if batch.get(NAMES, None):
+                parser.touch_names(storage)
+            parser.sort_file_tables(storage, merged_again)
+
     @util.measure
-    def parse_all(self, sources, **kwargs):
+    def parse_all(self, sources, storage=None, batch_size=BATCH_SIZE, **kwargs):
+        """Parse sources in parallel and merge the result into storage
+
+        Workers take translation units one by one from a queue ordered by
+        cost, so that a slow unit does not leave other cores idle. Each
+        worker sends the result of a translation unit as soon as it is
+        parsed and results are merged into storage every batch_size units, so
+        memory is bounded by a batch instead of the whole project. A new dict
+        is used when storage is not given. Closures of classes and methods
+        whose relations changed are written to HIERARCHY at the end.
+        """
         # from http://eli.thegreenplace.net/2012/01/16/python-parallelizing-cpu-bound-tasks-with-multiprocessing
         exclude_filters = '/usr/include'
         sources = filter(lambda s: not s[0].startswith(exclude_filters), sources)
         sources = filter(lambda s: not s[0].endswith('.c'), sources)
 
+        if storage is None:
+            storage = {}
+
+        # files included by many translation units are indexed only once
+        manager = mp.Manager()
+        kwargs.setdefault('indexed_files', manager.dict())
+
         # sources = filter(lambda s: s[0].endswith('hello.cpp'), sources)
-        def worker(dirname, jobs, out_q):
-            result_dict = {}
-            files = {}
-            for job in jobs:
+        def worker(dirname, job_q, out_q):
+            instrument.reset()
+            for job in iter(job_q.get, None):
                 filename = job[0]
-                result_dict[filename] = apply_parse(job, basedir = dirname, **kwargs)
-                files[filename] = time.time()
+                state = util.file_state(filename)
+                profile = self.get_profile(filename)
+                begin = time.time()
+                result = apply_parse(job, basedir = dirname, profile = profile, **kwargs)
+                end = time.time()
+                out_q.put((filename, state, profile, end - begin, result))
+            # stats of this worker tell it finished
+            instrument.collect_profiles()
+            out_q.put(instrument.stats)
 
-            parsed_dict = {}
-            for result in result_dict.values():
-                merge_recurse_inplace(parsed_dict, result)
-            parsed_dict[FILES] = files
-            out_q.put(parsed_dict)
-
-        out_q = mp.Queue()
         nprocs = mp.cpu_count()
-        jobs = sources
-        chunksize = int(math.ceil(len(jobs) / float(nprocs)))
-        procs = []
+        job_q = mp.Queue()
+        out_q = mp.Queue(nprocs * 2)
+        for job in self.order_by_cost(sources, storage.get(FILES, None)):
+            job_q.put(job)
+        for i in range(nprocs):
+            job_q.put(None)
 
+        procs = []
         for i in range(nprocs):
-            p = mp.Process(
-                target=worker,
-                args=(self.basedir, jobs[chunksize * i:chunksize * (i + 1)],
-                      out_q))
+            p = mp.Process(target=worker, args=(self.basedir, job_q, out_q))
             procs.append(p)
             p.start()
 
-        parsed_dict = {}
-
-        for i in range(nprocs):
-            result = out_q.get()
-            merge_recurse_inplace(parsed_dict, result)
+        batch = {}
+        states = {}
+        refreshed = self.get_shared_files(storage.get(FILES, None),
+                                          [source[0] for source in sources])
+        touched = set()
+        nbatch = 0
+        finished = 0
+        while finished < nprocs:
+            item = out_q.get()
+            if isinstance(item, instrument.Stats):
+                instrument.stats.update(item)
+                finished += 1
+                continue
+            self.fold(batch, states, *item)
+            nbatch += 1
+            if nbatch >= batch_size:
+                self.update(storage, batch, refreshed, touched, self.basedir)
+                batch = {}
+                nbatch = 0
+        self.update(storage, batch, refreshed, touched, self.basedir)
+        with instrument.phase('hierarchy'):
+            parser.update_hierarchy(storage, touched)
 
         for p in procs:
             p.join()
+        manager.shutdown()
 
-        parsed_dict['basedir'] = self.basedir
+        storage['basedir'] = self.basedir
 
-        return parsed_dict
+        return storage
 
-
-    def parse_all_single(self, sources, **kwargs):
-        pp = pprint.PrettyPrinter(indent=4)
-        parsed_dict = {}
-        parsed_dict[FILES] = {}
-        for job in sources:
+    @util.measure
+    def parse_all_single(self, sources, storage=None, batch_size=BATCH_SIZE, **kwargs):
+        """Parse sources in this process and merge the result into storage
+
+        Translation units parsed with reparse=True are kept in this process,
+        so calling it again for modified sources reuses their preambles.
+        """
+        if storage is None:
+            storage = {}
+        kwargs.setdefault('indexed_files', {})
+
+        batch = {}
+        states = {}
+        refreshed = self.get_shared_files(storage.get(FILES, None),
+                                          [source[0] for source in sources])
+        touched = set()
+        for i, job in enumerate(sources):
             filename = job[0]
-            result = apply_parse(job, basedir = self.basedir, **kwargs)
-            result[FILES] = {}
-            result[FILES][filename] = time.time()
-            merge_recurse_inplace(parsed_dict, result)
-
-        parsed_dict['basedir'] = self.basedir
-
-        return parsed_dict
+            state = util.file_state(filename)
+            profile = self.get_profile(filename)
+            begin = time.time()
+            result = apply_parse(job, basedir = self.basedir, profile = profile, **kwargs)
+            end = time.time()
+            self.fold(batch, states, filename, state, profile, end - begin, result)
+            if (i + 1) % batch_size == 0:
+                self.update(storage, batch, refreshed, touched, self.basedir)
+                batch = {}
+        self.update(storage, batch, refreshed, touched, self.basedir)
+        with instrument.phase('hierarchy'):
+            parser.update_hierarchy(storage, touched)
+
+        storage['basedir'] = self.basedir
+
+        return storage
+
+    def update_modified(self, storage, **kwargs):
+        """Parse sources modified since they were parsed into storage
+
+        Sources no longer scanned are removed first. Parsing is done in this
+        process, so with reparse=True translation units are kept and parsed
+        again from their preambles next time. Return the parsed sources.
+        """
+        scanned_list = self.scan()
+        self.remove_unscanned(storage, scanned_list)
+        files = storage.get(FILES, None)
+        files = files and dict(files.iteritems())
+        if files:
+            scanned_list = self.scan_modified(scanned_list, files)
+        if scanned_list:
+            self.parse_all_single(scanned_list, storage, **kwargs)
+        return scanned_list
 
 if __name__ == '__main__':
     libclang_set_library_file()
@@ -167,12 +489,13 @@ if __name__ == '__main__':
     builddir = os.path.abspath(sys.argv[1])
     basedir = os.path.abspath(sys.argv[2])
     action = None
-    if len(sys.argv) == 4:
+    if len(sys.argv) >= 4:
         action = sys.argv[3]
+    # --profile phase,... profiles phases with cProfile
+    if len(sys.argv) == 6 and sys.argv[4] == '--profile':
+        instrument.configure(sys.argv[5].split(','))
     project = Project(builddir, basedir)
 
-    parsed_dict = {}
-
     import pprint
     pp = pprint.PrettyPrinter(indent=4)
 
@@ -190,7 +513,10 @@ if __name__ == '__main__':
         sys.exit(0)
     elif action == 'parse':
         scanned_list = project.scan()
-        files = project.get_files_from_db(dbname)
+        storage = open_storage(dbname)
+        project.remove_unscanned(storage, scanned_list)
+        files = storage.get(FILES, None)
+        files = files and dict(files.iteritems())
 
         pp.pprint(files)
 
@@ -198,22 +524,31 @@ if __name__ == '__main__':
             scanned_list = project.scan_modified(scanned_list, files)
             logging.debug('scanned_list: {}'.format([x[0] for x in scanned_list]))
 
-        parsed_dict = project.parse_all(scanned_list)
-        pp.pprint('Parsed {} in {} with keys'.format(len(parsed_dict), builddir))
-        pp.pprint(parsed_dict.keys())
+        project.parse_all(scanned_list, storage)
+        with instrument.phase('storage_close'):
+            storage.close()
+        instrument.write_summary(STATS_FILENAME)
+        print('Parsed {} files in {}'.format(len(scanned_list), builddir))
     elif action == 'parse_single':
-        scanned_list = project.scan()
-        files = project.get_files_from_db(dbname)
-
-        if files:
-            scanned_list = project.scan_modified(scanned_list, files)
-
-        parsed_dict = project.parse_all_single(scanned_list)
-        pp.pprint('Parsed {} in {} with keys'.format(len(parsed_dict), builddir))
-        pp.pprint(parsed_dict.keys())
-
-    storage = Storage(dbname, writeback=True)
-    storage_update = util.measure(storage.update)
-
-    merge_recurse_inplace(storage, parsed_dict, Storage)
-    storage.close()
+        storage = open_storage(dbname)
+        scanned_list = project.update_modified(storage)
+        with instrument.phase('storage_close'):
+            storage.close()
+        instrument.write_summary(STATS_FILENAME)
+        print('Parsed {} files in {}'.format(len(scanned_list), builddir))
+    elif action == 'watch':
+        # watch [seconds] parses modified sources again until interrupted,
+        # reusing preambles of the translation units kept in this process
+        interval = len(sys.argv) == 5 and float(sys.argv[4]) or WATCH_INTERVAL
+        storage = open_storage(dbname)
+        try:
+            while True:
+                scanned_list = project.update_modified(storage, reparse=True)
+                if scanned_list:
+                    storage.sync()
+                    print('Parsed {} files in {}'.format(len(scanned_list), builddir))
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            storage.close()
@@ -4,12 +4,18 @@
 
 from common import *
 from enum import Enum           # pip install enum34
-from storage import ShelveStorage
+from storage import open_storage
+import SocketServer
+import UserDict
+import bisect
 import clang.cindex
+import collections
+import instrument
 import logging
 import os
 import parser
-import pygraphviz
+import pprint
+import signal
 import sys
 
 def make_locus(line, column):
@@ -22,6 +28,152 @@ class Query(Enum):
     ReferenceInherit   = 3
     SymbolInfo         = 4
     ClassHierarchy     = 5
+    Name               = 6
+    Completion         = 7
+    Outline            = 8
+
+# Query types taking a symbol name instead of a location
+NAME_QUERIES = (Query.Name, Query.Completion)
+
+# Query types taking a file, optionally with a range of lines 'file:first:last'
+FILE_QUERIES = (Query.Outline,)
+
+# Most results of a name query
+NAME_LIMIT = 200
+
+# Requests of a batch grouped by file at once
+BATCH_CHUNK_SIZE = 1000
+
+class NameIndex(object):
+    """Sorted spellings of symbols for prefix and substring search
+
+    Prefix search is a binary search. Substring search scans one string
+    joining every name, so both answer without looking up symbols.
+    Storage with prefixed_item_keys answers prefix search itself, see
+    query_completion.
+    """
+
+    def __init__(self, names):
+        self.names = sorted(names)
+        self.starts = []
+        offset = 0
+        for name in self.names:
+            self.starts.append(offset)
+            offset += len(name) + 1
+        self.text = '\n'.join(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def prefix(self, prefix, limit=NAME_LIMIT):
+        "Return names starting with prefix"
+        result = []
+        i = bisect.bisect_left(self.names, prefix)
+        while i < len(self.names) and len(result) < limit and \
+              self.names[i].startswith(prefix):
+            result.append(self.names[i])
+            i += 1
+        return result
+
+    def substring(self, substring, limit=NAME_LIMIT):
+        "Return names containing substring"
+        result = []
+        if not substring or '\n' in substring:
+            return result
+        pos = self.text.find(substring)
+        while pos != -1 and len(result) < limit:
+            i = bisect.bisect_right(self.starts, pos) - 1
+            result.append(self.names[i])
+            if i + 1 == len(self.names):
+                break
+            pos = self.text.find(substring, self.starts[i + 1])
+        return result
+
+# (parsed_dict, GENERATION, NameIndex) of each parsed_dict queried in this
+# process, built on first name query and again once NAMES was written
+name_indexes = {}
+
+def get_name_index(parsed_dict):
+    key = id(parsed_dict)
+    generation = parsed_dict.get(GENERATION, None)
+    if key not in name_indexes or name_indexes[key][0] is not parsed_dict or \
+       name_indexes[key][1] != generation:
+        names = parsed_dict[NAMES].keys() if NAMES in parsed_dict else []
+        name_indexes[key] = (parsed_dict, generation, NameIndex(names))
+    return name_indexes[key][2]
+
+def query_completion(prefix, parsed_dict):
+    """Return names of symbols starting with prefix
+
+    Storage looks up only the names starting with prefix, so a process
+    answering one completion does not read every name into NameIndex.
+    """
+    if hasattr(parsed_dict, 'prefixed_item_keys'):
+        return parsed_dict.prefixed_item_keys(NAMES, prefix, NAME_LIMIT)
+    return get_name_index(parsed_dict).prefix(prefix)
+
+def query_name(substring, parsed_dict):
+    "Return definition, or declaration, of each symbol whose name contains substring"
+    names = parsed_dict[NAMES]
+    locations = []
+    for name in get_name_index(parsed_dict).substring(substring):
+        for usr in names.get(name, []):
+            if usr in parsed_dict:
+                value = parsed_dict[usr]
+                location = value.get(DEFI, None) or value.get(DECL, None)
+                if location:
+                    locations.append(location)
+    return locations
+
+def split_file_request(location):
+    """Return (filename, first line, last line) of 'file' or 'file:first:last'
+
+    Lines are None for a whole file.
+    """
+    parts = location.rsplit(':', 2)
+    if len(parts) == 3 and parts[1].isdigit() and parts[2].isdigit():
+        return parts[0], int(parts[1]), int(parts[2])
+    return location, None, None
+
+def query_outline(location, parsed_dict):
+    """Return (line, column, kind, spelling) of declarations and definitions of a file
+
+    Outlines are sorted by line when parsed, so the one of a file is read
+    at once and a range of lines is found by binary search.
+    """
+    filename, first, last = split_file_request(location)
+    filename = parser.get_basename(filename, parsed_dict['basedir'])
+    outline = parsed_dict[OUTLINES][filename]
+    if first is None:
+        return outline
+    begin = bisect.bisect_left(outline, (first,))
+    end = bisect.bisect_left(outline, (last + 1,))
+    return outline[begin:end]
+
+def find_locus(filename, line, column, parsed_dict):
+    """Return locus of the token of filename at line and column
+
+    A column inside a token is resolved to the column the token starts at
+    by binary search in SPANS, so a query need not be on the first
+    character of a name. SPANS are read only if there is no entry at line
+    and column. The locus of line and column is returned for files without
+    SPANS and columns outside any token.
+    """
+    basename = parser.get_basename(filename, parsed_dict['basedir'])
+    locus = make_locus(line, column)
+    try:
+        if locus in parsed_dict[basename]:
+            return locus
+        spans = parsed_dict[SPANS][basename]
+    except KeyError:
+        return locus
+    i = bisect.bisect_right(spans, (line, column, sys.maxint))
+    while i > 0 and spans[i - 1][0] == line:
+        i -= 1
+        _, first, end = spans[i]
+        if first <= column < end:
+            return make_locus(line, first)
+    return locus
 
 def fullpath(filename, basedir):
     assert(filename and not os.path.isabs(filename))
@@ -106,43 +258,11 @@ def query_reference_inherit(filename, locus, parsed_dict):
 
     locations = []
     if KIND in parsed_dict[any_usr] and parsed_dict[any_usr][KIND] == 'CXX_METHOD':
-        def visit_hierarchy(usr, parsed_dict, visited_nodes):
-            p = parsed_dict
-            if SPELL in p[usr]:
-                logging.debug('visit_hierarchy: {}'.format(p[usr][SPELL]))
-            # assert(p[usr][KIND] == 'CLASS_DECL')
-
-            for base in p[usr].get(BASE_CLASS, []):
-                if base in visited_nodes:
-                    continue
-                visited_nodes.add(base)
-                if SPELL in p[usr] and SPELL in p[base]:
-                    logging.debug('Processing {} - > {}'.format(p[usr][SPELL], p[base][SPELL]))
-                yield base
-                for node in visit_hierarchy(base, p, visited_nodes):
-                    yield node
-
-            for derived in p[usr].get(CHILD_CLASS, []):
-                if derived in visited_nodes:
-                    continue
-                visited_nodes.add(derived)
-                if SPELL in p[derived] and SPELL in p[usr]:
-                    logging.debug('Processing {} - > {}'.format(p[derived][SPELL], p[usr][SPELL]))
-                yield derived
-                for node in visit_hierarchy(derived, p, visited_nodes):
-                    yield node
-
-        # logging.info('parsed_dict[any_usr][KIND]: {}'.format(parsed_dict[any_usr][KIND]))
-        method_position = any_usr.rfind('@F')
-        class_usr = any_usr[:method_position]
-        method_name = any_usr[method_position:]
-        assert(len(class_usr) and parsed_dict[class_usr])
-
-        visited_nodes = set()
-        for node in visit_hierarchy(class_usr, parsed_dict, visited_nodes):
-            node_usr = node + method_name
-            if node_usr in parsed_dict:
-                locations.extend(parsed_dict[node_usr][REFS])
+        # methods it overrides and methods overriding it, transitively
+        ancestors, descendants = parser.get_closure(parsed_dict, any_usr)
+        for usr in ancestors + descendants:
+            if usr in parsed_dict:
+                locations.extend(parsed_dict[usr].get(REFS, []))
     locations.extend(parsed_dict[any_usr][REFS])
 
     return locations
@@ -155,7 +275,7 @@ def query_symbol_info(filename, locus, parsed_dict):
     assert(not os.path.isabs(filename))
     target = parsed_dict[filename][locus]
 
-    return {'{}:{}'.format(filename, locus): target, any_usr: parsed_dict[any_usr]}
+    return {'{}:{}'.format(filename, locus): dict(target), any_usr: dict(parsed_dict[any_usr])}
 
 @basename
 def query_class_hierarchy(filename, locus, parsed_dict, **kwargs):
@@ -166,36 +286,25 @@ def query_class_hierarchy(filename, locus, parsed_dict, **kwargs):
     if not parsed_dict[any_usr][KIND] in ('TYPE_REF', 'CLASS_DECL', 'CXX_BASE_SPECIFIER'):
         return None
 
-    def visit_hierarchy(usr, parsed_dict, visited_edges):
+    def class_pairs(usr, parsed_dict):
+        "Yield (derived, base) spellings of classes connected to usr by inheritance"
         p = parsed_dict
-        logging.debug('visit_hierarchy: {}'.format(p[usr][SPELL]))
-        assert(p[usr][KIND] in ('CLASS_DECL', 'TYPE_REF', 'CXX_BASE_SPECIFIER'))
-
-        for base in p[usr].get(BASE_CLASS, []):
-            edge = (usr, base)
-            if edge in visited_edges:
-                continue
-            visited_edges.add(edge)
-            logging.debug('Processing {} - > {}'.format(p[usr][SPELL], p[base][SPELL]))
-            yield p[usr][SPELL], p[base][SPELL]
-            for edge in visit_hierarchy(base, p, visited_edges):
-                yield edge
-
-        for derived in p[usr].get(CHILD_CLASS, []):
-            edge = (derived, usr)
-            if edge in visited_edges:
-                continue
-            visited_edges.add(edge)
-            logging.debug('Processing {} - > {}'.format(p[derived][SPELL], p[usr][SPELL]))
-            yield p[derived][SPELL], p[usr][SPELL]
-            for edge in visit_hierarchy(derived, p, visited_edges):
-                yield edge
+        relations = {}
+        visited = set([usr])
+        stack = [usr]
+        while stack:
+            node = stack.pop()
+            bases, children = parser.get_relations(p, node, relations)
+            for base in bases:
+                logging.debug('Processing {} - > {}'.format(p[node][SPELL], p[base][SPELL]))
+                yield p[node][SPELL], p[base][SPELL]
+            for relative in bases + children:
+                if relative not in visited:
+                    visited.add(relative)
+                    stack.append(relative)
 
     def generate_class_hierarachy(usr, parsed_dict, export_as="text", output_filename=None):
-        visited_edges = set()
-        pairs = set()
-        for derived, base in visit_hierarchy(usr, parsed_dict, visited_edges):
-            pairs.add((derived, base))
+        pairs = set(class_pairs(usr, parsed_dict))
 
         if export_as == "text":
             return pairs
@@ -204,6 +313,8 @@ def query_class_hierarchy(filename, locus, parsed_dict, **kwargs):
             graph.layout(prog='dot')
             graph.draw(output_filename)
 
+        # imported here to keep startup of the other queries cheap
+        import pygraphviz
         graph = pygraphviz.AGraph(directed=True, rankdir='BT')
         graph.node_attr['shape'] = 'record'
         graph.node_attr['fontname'] = 'Helvetica'
@@ -230,6 +341,15 @@ def query_class_hierarchy(filename, locus, parsed_dict, **kwargs):
     return generate_class_hierarachy(any_usr, parsed_dict, export_as)
 
 def query(query_type, location, parsed_dict):
+    if query_type in NAME_QUERIES or query_type in FILE_QUERIES:
+        funcs = {
+            Query.Name:       query_name,
+            Query.Completion: query_completion,
+            Query.Outline:    query_outline,
+        }
+        with instrument.phase('query_{}'.format(query_type.name)):
+            return funcs[query_type](location, parsed_dict)
+
     if not location:
         if query_type == Query.Reference:
             return []
@@ -241,7 +361,6 @@ def query(query_type, location, parsed_dict):
     assert filename
     assert line
     assert column
-    locus = make_locus(line, column)
 
     funcs = {
         Query.Definition:       query_definition,
@@ -252,9 +371,15 @@ def query(query_type, location, parsed_dict):
         Query.ClassHierarchy:   query_class_hierarchy
     }
 
-    return funcs[query_type](filename, locus, parsed_dict)
+    with instrument.phase('query_{}'.format(query_type.name)):
+        locus = find_locus(filename, line, column, parsed_dict)
+        return funcs[query_type](filename, locus, parsed_dict)
+
+def location_with_text(location, basedir, texts=None):
+    """Return full location followed by text of its line
 
-def location_with_text(location, basedir):
+    texts, if given, keeps lines of each file read for later calls.
+    """
     filename, line, column = location.split(':')
     line = int(line)
     column = int(column)
@@ -262,6 +387,14 @@ def location_with_text(location, basedir):
     fullpath = basedir + filename
     fulllocation = '{}:{}:{}'.format(fullpath, line, column)
 
+    if texts is not None:
+        if fullpath not in texts:
+            with open(fullpath) as f:
+                texts[fullpath] = f.read().splitlines()
+        lines = texts[fullpath]
+        text = line <= len(lines) and lines[line - 1].rstrip() or ''
+        return '{}:{}'.format(fulllocation, text)
+
     assert os.path.exists(fullpath)
     with open(fullpath) as f:
         text = ''
@@ -271,40 +404,233 @@ def location_with_text(location, basedir):
                 break
         return '{}:{}'.format(fulllocation, text)
 
-if __name__ == '__main__':
-    libclang_set_library_file()
-    logging.basicConfig(level=logging.INFO)
-    assert len(sys.argv) >= 4
-    filename = sys.argv[1]
-    query_type = sys.argv[2]
-    query_location = sys.argv[3]
-    if filename.endswith('.db'):
-        parsed_dict = ShelveStorage(filename)
-    else:
-        parsed_dict = parser.parse(filename)
-
-    import os
+def query_lines(query_type, location, parsed_dict, texts=None):
+    """Run query and return its result formatted as output lines
 
+    texts is passed to location_with_text.
+    """
     basedir = parsed_dict['basedir']
-    if query_type == Query.SymbolInfo:
-        basedir = None
-    locations = query(Query[query_type], query_location, parsed_dict)
-    assert locations
-    if isinstance(locations, list):
+    result = query(query_type, location, parsed_dict)
+    if query_type == Query.Outline:
+        # file:line:column:KIND spelling
+        path = basedir + parser.get_basename(split_file_request(location)[0], basedir)
+        return ['{}:{}:{}:{} {}'.format(path, line, column, kind, spell)
+                for line, column, kind, spell in result]
+    if not result:
+        raise KeyError(location)
+
+    if query_type == Query.Completion:
+        return result
+    elif isinstance(result, list):
         # Sort order by line as integer first and by filename later to keep ordering
         # https://wiki.python.org/moin/HowTo/Sorting#Maintaining_Sort_Order
-        unique_locations = list(set(locations))
+        unique_locations = list(set(result))
         line_sorted = sorted(unique_locations, key=lambda x: int(x.split(':')[1]))
         filename_sorted = sorted(line_sorted, key=lambda x: x.split(':')[0])
-        for location in filename_sorted:
-            print(location_with_text(location, basedir))
-    elif isinstance(locations, dict):
-        import pprint
+        return [location_with_text(location, basedir, texts) for location in filename_sorted]
+    elif isinstance(result, dict):
         pp = pprint.PrettyPrinter(indent=4)
-        pp.pprint(locations)
+        return pp.pformat(result).splitlines()
+    elif query_type == Query.ClassHierarchy:
+        return [str(result)]
     else:
-        if query_type == 'ClassHierarchy':
-            print(locations)
+        return [location_with_text(result, basedir, texts)]
+
+class BatchView(UserDict.DictMixin):
+    """parsed_dict whose entries are read at most once
+
+    Dict valued entries, such as locus tables and symbols, are returned
+    as nested BatchView, so each locus and each attribute of a symbol a
+    batch looks up is read once, and only those are read. A nested view
+    asked for its keys reads all its entries at once.
+    """
+
+    def __init__(self, parsed_dict, nested=False):
+        self.parsed_dict = parsed_dict
+        self.nested = nested
+        self.complete = False
+        self.cache = {}
+
+    def wrap(self, value):
+        if isinstance(value, (dict, UserDict.DictMixin)):
+            return BatchView(value, True)
+        return value
+
+    def __getitem__(self, key):
+        if key not in self.cache:
+            self.cache[key] = self.wrap(self.parsed_dict[key])
+        return self.cache[key]
+
+    def __contains__(self, key):
+        return key in self.cache or not self.complete and key in self.parsed_dict
+
+    def keys(self):
+        if self.nested and not self.complete:
+            for key, value in self.parsed_dict.iteritems():
+                if key not in self.cache:
+                    self.cache[key] = self.wrap(value)
+            self.complete = True
+        if self.complete:
+            return self.cache.keys()
+        return self.parsed_dict.keys()
+
+    def forget(self, key):
+        "Forget key, and the entry of file key in SORTED_FILE_TABLES"
+        self.cache.pop(key, None)
+        self.complete = False
+        for table in SORTED_FILE_TABLES:
+            if table in self.cache:
+                self.cache[table].forget(key)
+
+def get_request_file(query_type, location):
+    "Return file a request looks up, None for NAME_QUERIES"
+    if query_type in NAME_QUERIES:
+        return None
+    if query_type in FILE_QUERIES:
+        return split_file_request(location)[0]
+    return location.rsplit(':', 2)[0]
+
+def query_batch(requests, parsed_dict, chunk_size=BATCH_CHUNK_SIZE):
+    """Yield (query_type, location, lines or exception) for each request
+
+    requests is an iterable of (query_type, location). Each chunk_size of
+    them is answered grouped by file, so each locus table and each symbol
+    is read once per chunk, and yielded before the next chunk is read.
+    """
+    chunk = []
+    for request in requests:
+        chunk.append(request)
+        if len(chunk) >= chunk_size:
+            for result in query_chunk(chunk, parsed_dict):
+                yield result
+            chunk = []
+    for result in query_chunk(chunk, parsed_dict):
+        yield result
+
+def query_chunk(requests, parsed_dict):
+    groups = collections.OrderedDict()
+    for query_type, location in requests:
+        groups.setdefault(get_request_file(query_type, location), []).append(
+            (query_type, location))
+
+    view = BatchView(parsed_dict)
+    texts = {}
+    for filename, group in groups.iteritems():
+        for query_type, location in group:
+            try:
+                # name queries keep their index per parsed_dict
+                target = query_type in NAME_QUERIES and parsed_dict or view
+                yield query_type, location, query_lines(query_type, location, target, texts)
+            except Exception as e:
+                logging.debug('query_batch: {} {} failed: {!r}'.format(
+                    query_type, location, e))
+                yield query_type, location, e
+        if filename:
+            view.forget(parser.get_basename(filename, parsed_dict['basedir']))
+
+def serve_batch(parsed_dict, rfile, wfile):
+    """Answer requests read from rfile as a batch
+
+    Requests are as for serve. Responses are streamed grouped by file, so
+    each echoes its request: 'OK <n> <QueryType> <location>' followed by n
+    lines of result or 'ERR <QueryType> <location> <message>'.
+    """
+    def requests():
+        for request in iter(rfile.readline, ''):
+            request = request.rstrip('\n')
+            if not request:
+                continue
+            try:
+                query_type, location = request.split(' ', 1)
+                query_type = Query[query_type]
+            except (ValueError, KeyError) as e:
+                wfile.write('ERR {} {!r}\n'.format(request, e))
+                continue
+            yield query_type, location
+
+    for query_type, location, result in query_batch(requests(), parsed_dict):
+        if isinstance(result, Exception):
+            wfile.write('ERR {} {} {!r}\n'.format(query_type.name, location, result))
+        else:
+            wfile.write('OK {} {} {}\n'.format(len(result), query_type.name, location))
+            for line in result:
+                wfile.write(line + '\n')
+        wfile.flush()
+
+def serve(parsed_dict, rfile, wfile):
+    """Answer queries read from rfile line by line until EOF
+
+    A request is '<QueryType> <file:line:column>', '<QueryType> <name>'
+    for NAME_QUERIES or '<QueryType> <file[:first:last]>' for FILE_QUERIES. The response is either
+    'OK <n>' followed by n lines of result or 'ERR <message>'.
+    """
+    for request in iter(rfile.readline, ''):
+        request = request.rstrip('\n')
+        if not request:
+            continue
+        try:
+            query_type, location = request.split(' ', 1)
+            lines = query_lines(Query[query_type], location, parsed_dict)
+        except Exception as e:
+            logging.debug('serve: {} failed: {!r}'.format(request, e))
+            wfile.write('ERR {!r}\n'.format(e))
         else:
-            print(location_with_text(locations, basedir))
+            wfile.write('OK {}\n'.format(len(lines)))
+            for line in lines:
+                wfile.write(line + '\n')
+        wfile.flush()
+
+class QueryServer(SocketServer.UnixStreamServer):
+    """Serve queries on unix domain socket keeping parsed_dict open"""
+
+    class Handler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            serve(self.server.parsed_dict, self.rfile, self.wfile)
+
+    def __init__(self, path, parsed_dict):
+        if os.path.exists(path):
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, self.Handler)
+        self.parsed_dict = parsed_dict
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+if __name__ == '__main__':
+    libclang_set_library_file()
+    logging.basicConfig(level=logging.INFO)
+    assert len(sys.argv) >= 3
+    filename = sys.argv[1]
+    if filename.endswith('.db'):
+        parsed_dict = open_storage(filename, 'r')
+    else:
+        parsed_dict = parser.parse(filename)
+
+    if sys.argv[2] == '--batch':
+        # python -m stags.query stags.db --batch < requests
+        serve_batch(parsed_dict, sys.stdin, sys.stdout)
+        sys.exit(0)
+
+    if sys.argv[2] == '--server':
+        # python -m stags.query stags.db --server [socket]
+        if len(sys.argv) >= 4:
+            server = QueryServer(sys.argv[3], parsed_dict)
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
+        else:
+            serve(parsed_dict, sys.stdin, sys.stdout)
+        sys.exit(0)
+
+    assert len(sys.argv) >= 4
+    query_type = sys.argv[2]
+    query_location = sys.argv[3]
 
+    for line in query_lines(Query[query_type], query_location, parsed_dict):
+        print(line)
@@ -43,6 +43,10 @@ Notice that using \\[next-error] or \\[compile-goto-error] modifies
 (defvar stags-rootdir nil
   "Root directory of source tree where stags.db file exist.")
 
+(defvar stags-server-socket nil
+  "Unix domain socket of a running `stags.query' server.
+When nil or missing, each query spawns its own python process.")
+
 (defvar stags-mode-map
   (let ((map (make-sparse-keymap)))
     (set-keymap-parent map compilation-minor-mode-map)
@@ -104,7 +108,50 @@ Notice that using \\[next-error] or \\[compile-goto-error] modifies
 (defvar stags-history-list nil
   "stags history list.")
 
-(defun stags-completing-reference ())
+(defun stags-complete-name (prefix)
+  "Return names of symbols starting with `prefix'."
+  (with-temp-buffer
+    (when (= (stags-call-query "Completion" prefix) 0)
+      (split-string (buffer-string) "\n" t))))
+
+(defun stags-completing-reference ()
+  "Read symbol name with completion and list symbols having it."
+  (interactive)
+  (when (not stags-rootdir)
+    (error "stags-rootdir nil"))
+  (let* ((name (completing-read "Symbol: "
+                                (completion-table-dynamic 'stags-complete-name)
+                                nil nil (stags-current-token) 'stags-history-list))
+         (buffer (generate-new-buffer (generate-new-buffer-name (concat "*STAGS SELECT* " name)))))
+    (set-buffer buffer)
+    (stags-call-query "Name" name)
+    (stags-mode)
+    (beginning-of-buffer)
+    (switch-to-buffer buffer)))
+
+;; (add-hook 'c++-mode-hook
+;;           (lambda () (setq imenu-create-index-function 'stags-imenu-create-index)))
+(defun stags-imenu-create-index ()
+  "Return imenu index of declarations and definitions of the current file."
+  (let ((filename (expand-file-name (buffer-file-name)))
+        (index))
+    (with-temp-buffer
+      (when (= (stags-call-query "Outline" filename) 0)
+        (goto-char (point-min))
+        (while (re-search-forward "^.*:\\([0-9]+\\):\\([0-9]+\\):\\([A-Z_]+\\) \\(.*\\)$" nil t)
+          (push (list (match-string 4)
+                      (string-to-number (match-string 1))
+                      (string-to-number (match-string 2)))
+                index))))
+    (save-excursion
+      (save-restriction
+        (widen)
+        (mapcar (lambda (entry)
+                  (goto-char (point-min))
+                  (forward-line (1- (nth 1 entry)))
+                  (forward-char (1- (nth 2 entry)))
+                  (cons (nth 0 entry) (point-marker)))
+                (nreverse index))))))
 
 (defun stags-get-db-name ()
   (expand-file-name (concat stags-rootdir "/stags.db")))
@@ -133,38 +180,59 @@ Notice that using \\[next-error] or \\[compile-goto-error] modifies
   (interactive)
   (stags-query "ClassHierarchy"))
 
+(defun stags-start-server ()
+  "Start query server keeping stags.db of `stags-rootdir' open."
+  (interactive)
+  (when (not stags-rootdir)
+    (error "stags-rootdir nil"))
+  (let ((socket (expand-file-name (concat stags-rootdir "/stags.sock"))))
+    (start-process "stags-server" " *stags-server*"
+                   "python" "-m" "stags.query" (stags-get-db-name) "--server" socket)
+    (setq stags-server-socket socket)))
+
+(defun stags-server-request (type location)
+  "Send query to `stags-server-socket' and insert the result at point.
+Return 0 on success like `call-process'."
+  (let ((start (point))
+        (proc (make-network-process :name "stags-client"
+                                    :buffer (current-buffer)
+                                    :family 'local
+                                    :service stags-server-socket)))
+    (set-process-sentinel proc 'ignore)
+    (process-send-string proc (format "%s %s\n" type location))
+    (process-send-eof proc)
+    (while (eq (process-status proc) 'open)
+      (accept-process-output proc 1))
+    (goto-char start)
+    (if (looking-at "OK [0-9]+\n")
+        (progn
+          (delete-region (match-beginning 0) (match-end 0))
+          0)
+      1)))
+
+(defun stags-call-query (type location)
+  "Query `location' by server if running or by new python process."
+  (if (and stags-server-socket (file-exists-p stags-server-socket))
+      (stags-server-request type location)
+    (call-process "python" nil t nil
+                  "-m"
+                  "stags.query"
+                  (stags-get-db-name)
+                  type
+                  location)))
+
 (defun stags-query (type)
   "Send query `type' to db"
   (when (not stags-rootdir)
     (error "stags-rootdir nil"))
   (let* ((filename (expand-file-name (buffer-file-name)))
+         ;; any column of a name is resolved to the name by stags.query
          (locus (format "%d:%d" (line-number-at-pos) (1+ (current-column))))
-         (locus-fallback)
          (token (stags-current-token))
-         (token-fallback)
-         (query)
          (status)
          (buffer (generate-new-buffer (generate-new-buffer-name (concat "*STAGS SELECT* " token)))))
-    (save-excursion
-      (backward-word)
-      (setq token-fallback (stags-current-token))
-      (setq locus-fallback (format "%d:%d" (line-number-at-pos) (1+ (current-column)))))
     (set-buffer buffer)
-    (setq status (call-process "python" nil t nil
-                               "-m"
-                               "stags.query"
-                               (stags-get-db-name)
-                               type
-                               (concat filename ":" locus)))
-    (when (and (string-equal token token-fallback) (not (= status 0)))
-      (erase-buffer)
-      (message "query failed(%d) try with locus-fallback: %s" status locus-fallback)
-      (setq status (call-process "python" nil t nil
-                                 "-m"
-                                 "stags.query"
-                                 (stags-get-db-name)
-                                 type
-                                 (concat filename ":" locus-fallback))))
+    (setq status (stags-call-query type (concat filename ":" locus)))
 
     (if (string-equal type "SymbolInfo")
         (progn
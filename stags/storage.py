@@ -2,8 +2,16 @@
 
 """
 
+from common import DECL, DEFI, FILE_USRS, REFS, REF_USR, TEMPLATE_USR, USR
+from mergedict import merge_recurse_inplace
 import UserDict
+import array
+import cPickle as pickle
+import logging
+import os
 import shelve
+import sqlite3
+import whichdb
 
 class ShelveStorage(UserDict.DictMixin):
     def __init__(self, filename, *args, **kwargs):
@@ -24,6 +32,15 @@ class ShelveStorage(UserDict.DictMixin):
     def keys(self):
         return self.dict.keys()
 
+    def merge(self, d):
+        """Merge dict into storage writing back each touched key"""
+        for key, value in d.iteritems():
+            if key in self.dict:
+                merged = {key: self.dict[key]}
+                merge_recurse_inplace(merged, {key: value})
+                value = merged[key]
+            self.dict[key] = value
+
     def __del__(self):
         self.dict.close()
 
@@ -32,3 +49,410 @@ class ShelveStorage(UserDict.DictMixin):
 
     def sync(self):
         self.dict.sync()
+
+def dumps(value):
+    return sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+def loads(data):
+    return pickle.loads(str(data))
+
+class ItemView(UserDict.DictMixin):
+    """Dict valued entry of SqliteStorage reading and writing row by row"""
+
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.key = key
+
+    def __getitem__(self, subkey):
+        return self.storage.get_item(self.key, subkey)
+
+    def __setitem__(self, subkey, value):
+        self.storage.set_item(self.key, subkey, value)
+
+    def __delitem__(self, subkey):
+        self.storage.del_item(self.key, subkey)
+
+    def __contains__(self, subkey):
+        return self.storage.has_item(self.key, subkey)
+
+    def keys(self):
+        return self.storage.item_keys(self.key)
+
+    def iteritems(self):
+        return iter(self.storage.get_items(self.key))
+
+def split_location(location):
+    """Return (filename, line, column) of location 'file:line:col'
+
+    None is returned if location is not formatted so.
+    """
+    try:
+        filename, line, column = location.rsplit(':', 2)
+        return filename, int(line), int(column)
+    except (AttributeError, ValueError):
+        return None
+
+class SqliteStorage(UserDict.DictMixin):
+    """Storage keeping each entry of dict values as its own row
+
+    Each symbol attribute, each locus of a file and each reference is
+    addressable separately, so a lookup reads only the rows it asks for
+    instead of unpickling a whole nested dict. Dict values are returned as
+    ItemView which reads and writes through to the database.
+
+    Keys, filenames of locations and USRs of locus entries are interned in
+    names and referred to by id, and locations are stored as (file id,
+    line, column). USRs of FILE_USRS are stored as arrays of their ids.
+    They are translated back to strings when read.
+    """
+
+    SCHEMA_VERSION = 2
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS names (id INTEGER PRIMARY KEY, name TEXT UNIQUE)',
+        # data is NULL for dict values, which are stored in items
+        'CREATE TABLE IF NOT EXISTS keys (id INTEGER PRIMARY KEY, data BLOB)',
+        # data is NULL for REFS, which are stored in refs
+        'CREATE TABLE IF NOT EXISTS items (key INTEGER, subkey, data BLOB, '
+        'PRIMARY KEY (key, subkey))',
+        'CREATE TABLE IF NOT EXISTS refs (key INTEGER, file INTEGER, line INTEGER, '
+        'col INTEGER, PRIMARY KEY (key, file, line, col))',
+    )
+
+    TABLES = ('names', 'keys', 'items', 'refs')
+
+    # subkeys of items holding a location
+    LOCATION_KEYS = (DEFI, DECL)
+
+    # keys of locus entries holding a USR
+    USR_KEYS = (USR, REF_USR, TEMPLATE_USR)
+
+    # keys whose items are lists of USRs, stored as arrays of their ids
+    USR_LIST_KEYS = (FILE_USRS,)
+
+    MMAP_SIZE = 1 << 30
+
+    # host parameters of a statement allowed by default
+    MAX_VARIABLES = 999
+
+    conn = None
+
+    def __init__(self, filename, flag='c', protocol=None, writeback=False):
+        if flag == 'n' and os.path.exists(filename):
+            os.remove(filename)
+        self.ids = {}
+        self.names = {}
+        self.conn = sqlite3.connect(filename)
+        self.conn.text_factory = str
+        self.conn.execute('PRAGMA mmap_size = {}'.format(self.MMAP_SIZE))
+        if flag != 'r':
+            self.conn.execute('PRAGMA journal_mode = WAL')
+            version = self.execute('PRAGMA user_version').fetchone()[0]
+            if version != self.SCHEMA_VERSION:
+                if version or self.execute('SELECT 1 FROM sqlite_master').fetchone():
+                    logging.warning('{} has old schema, it is parsed again'.format(filename))
+                for table in self.TABLES:
+                    self.execute('DROP TABLE IF EXISTS {}'.format(table))
+                self.execute('PRAGMA user_version = {}'.format(self.SCHEMA_VERSION))
+            for statement in self.SCHEMA:
+                self.conn.execute(statement)
+
+    def execute(self, *args):
+        return self.conn.execute(*args)
+
+    def get_id(self, name, create=True):
+        """Return id of interned name
+
+        None is returned for a name not interned yet unless create.
+        """
+        if name in self.ids:
+            return self.ids[name]
+        row = self.execute('SELECT id FROM names WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            if not create:
+                return None
+            row = (self.execute('INSERT INTO names (name) VALUES (?)', (name,)).lastrowid,)
+        self.ids[name] = row[0]
+        self.names[row[0]] = name
+        return row[0]
+
+    def get_name(self, id):
+        if id not in self.names:
+            name = self.execute('SELECT name FROM names WHERE id = ?', (id,)).fetchone()[0]
+            self.ids[name] = id
+            self.names[id] = name
+        return self.names[id]
+
+    def get_names(self, ids):
+        "Return names of ids, reading those not cached yet at once"
+        missing = list(set(id for id in ids if id not in self.names))
+        for i in range(0, len(missing), self.MAX_VARIABLES):
+            chunk = missing[i:i + self.MAX_VARIABLES]
+            for id, name in self.execute('SELECT id, name FROM names WHERE id IN ({})'.format(
+                    ', '.join('?' * len(chunk))), chunk):
+                self.ids[name] = id
+                self.names[id] = name
+        return [self.names[id] for id in ids]
+
+    @staticmethod
+    def pack_ids(ids):
+        return sqlite3.Binary(array.array('i', ids).tostring())
+
+    @staticmethod
+    def unpack_ids(data):
+        return array.array('i', str(data)).tolist()
+
+    def pack(self, subkey, value):
+        "Return value of subkey with filenames and USRs replaced by ids"
+        if subkey in self.LOCATION_KEYS:
+            location = split_location(value)
+            if location:
+                return (self.get_id(location[0]),) + location[1:]
+        elif isinstance(value, dict):
+            return dict((k, self.get_id(v) if k in self.USR_KEYS and isinstance(v, str) else v)
+                        for k, v in value.iteritems())
+        return value
+
+    def unpack(self, subkey, value):
+        if subkey in self.LOCATION_KEYS and isinstance(value, tuple):
+            return self.format_location(*value)
+        elif isinstance(value, dict):
+            return dict((k, self.get_name(v) if k in self.USR_KEYS and isinstance(v, int) else v)
+                        for k, v in value.iteritems())
+        return value
+
+    def format_location(self, file, line, column):
+        if line is None:
+            return self.get_name(file)
+        return '{}:{}:{}'.format(self.get_name(file), line, column)
+
+    def pack_ref(self, key_id, location):
+        parts = split_location(location)
+        if parts is None:
+            return (key_id, self.get_id(location), None, None)
+        return (key_id, self.get_id(parts[0]), parts[1], parts[2])
+
+    def __getitem__(self, key):
+        key_id = self.get_id(key, False)
+        row = key_id and self.execute('SELECT data FROM keys WHERE id = ?', (key_id,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        if row[0] is None:
+            return ItemView(self, key)
+        return loads(row[0])
+
+    def __setitem__(self, key, value):
+        if isinstance(value, ItemView) and value.storage is self and value.key == key:
+            return
+        if isinstance(value, (dict, UserDict.DictMixin)):
+            value = dict(value)
+        if key in self:
+            del self[key]
+        key_id = self.get_id(key)
+        if isinstance(value, dict):
+            self.execute('INSERT INTO keys VALUES (?, NULL)', (key_id,))
+            for subkey, subvalue in value.iteritems():
+                self.set_item(key, subkey, subvalue)
+        else:
+            self.execute('INSERT INTO keys VALUES (?, ?)', (key_id, dumps(value)))
+
+    def __delitem__(self, key):
+        key_id = self.get_id(key, False)
+        if key_id is None or \
+           self.execute('DELETE FROM keys WHERE id = ?', (key_id,)).rowcount == 0:
+            raise KeyError(key)
+        self.execute('DELETE FROM items WHERE key = ?', (key_id,))
+        self.execute('DELETE FROM refs WHERE key = ?', (key_id,))
+
+    def __contains__(self, key):
+        key_id = self.get_id(key, False)
+        return key_id is not None and self.execute(
+            'SELECT 1 FROM keys WHERE id = ?', (key_id,)).fetchone() is not None
+
+    def has_key(self, key):
+        return key in self
+
+    def __iter__(self):
+        for row in self.execute('SELECT name FROM keys JOIN names ON keys.id = names.id'):
+            yield row[0]
+
+    def __len__(self):
+        return self.execute('SELECT COUNT(*) FROM keys').fetchone()[0]
+
+    def keys(self):
+        return list(self)
+
+    def get_item(self, key, subkey):
+        key_id = self.get_id(key, False)
+        row = key_id and self.execute('SELECT data FROM items WHERE key = ? AND subkey = ?',
+                                      (key_id, subkey)).fetchone()
+        if row is None:
+            raise KeyError(subkey)
+        if key in self.USR_LIST_KEYS:
+            return self.get_names(self.unpack_ids(row[0]))
+        if subkey == REFS and row[0] is None:
+            return [r[0] for r in self.execute(
+                "SELECT name || IFNULL(':' || line || ':' || col, '') FROM refs "
+                'JOIN names ON refs.file = names.id WHERE key = ? ORDER BY refs.rowid',
+                (key_id,))]
+        return self.unpack(subkey, loads(row[0]))
+
+    def get_items(self, key):
+        "Return (subkey, value) of every item of key read at once"
+        key_id = self.get_id(key, False)
+        if key in self.USR_LIST_KEYS:
+            return [(subkey, self.get_names(self.unpack_ids(data)))
+                    for subkey, data in self.execute(
+                        'SELECT subkey, data FROM items WHERE key = ?', (key_id,)).fetchall()]
+        return [(subkey, self.get_item(key, subkey) if subkey == REFS and data is None
+                 else self.unpack(subkey, loads(data)))
+                for subkey, data in self.execute(
+                    'SELECT subkey, data FROM items WHERE key = ?', (key_id,)).fetchall()]
+
+    def set_item(self, key, subkey, value):
+        key_id = self.get_id(key)
+        if subkey == REFS and isinstance(value, list):
+            self.execute('DELETE FROM refs WHERE key = ?', (key_id,))
+            self.add_refs(key, value)
+        elif key in self.USR_LIST_KEYS:
+            self.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?)',
+                         (key_id, subkey, self.pack_ids([self.get_id(usr) for usr in value])))
+        else:
+            self.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?)',
+                         (key_id, subkey, dumps(self.pack(subkey, value))))
+
+    def add_refs(self, key, locations):
+        key_id = self.get_id(key)
+        self.execute('INSERT OR REPLACE INTO items VALUES (?, ?, NULL)', (key_id, REFS))
+        self.conn.executemany('INSERT OR IGNORE INTO refs VALUES (?, ?, ?, ?)',
+                              [self.pack_ref(key_id, location) for location in locations])
+
+    def remove_refs(self, key, filename):
+        """Delete references of key located in filename
+
+        Only the rows of filename are deleted, instead of writing back the
+        rest of the list. The REFS item is deleted too if no reference is
+        left. Return whether any reference of key is left.
+        """
+        key_id = self.get_id(key, False)
+        file_id = self.get_id(filename, False)
+        if key_id is None:
+            return False
+        if file_id is not None:
+            self.execute('DELETE FROM refs WHERE key = ? AND file = ? AND line IS NOT NULL',
+                         (key_id, file_id))
+        if self.execute('SELECT 1 FROM refs WHERE key = ? LIMIT 1', (key_id,)).fetchone():
+            return True
+        self.execute('DELETE FROM items WHERE key = ? AND subkey = ?', (key_id, REFS))
+        return False
+
+    def del_item(self, key, subkey):
+        key_id = self.get_id(key, False)
+        if key_id is None or self.execute('DELETE FROM items WHERE key = ? AND subkey = ?',
+                                          (key_id, subkey)).rowcount == 0:
+            raise KeyError(subkey)
+        if subkey == REFS:
+            self.execute('DELETE FROM refs WHERE key = ?', (key_id,))
+
+    def has_item(self, key, subkey):
+        key_id = self.get_id(key, False)
+        return key_id is not None and self.execute(
+            'SELECT 1 FROM items WHERE key = ? AND subkey = ?',
+            (key_id, subkey)).fetchone() is not None
+
+    def item_keys(self, key):
+        return [row[0] for row in self.execute(
+            'SELECT subkey FROM items WHERE key = ?', (self.get_id(key, False),))]
+
+    def prefixed_item_keys(self, key, prefix, limit):
+        """Return up to limit sorted subkeys of key starting with prefix
+
+        They are read by a range of the primary key of items, without
+        reading the other subkeys.
+        """
+        key_id = self.get_id(key, False)
+        if key_id is None:
+            return []
+        # the least string greater than every one starting with prefix
+        upper = prefix.rstrip('\xff')
+        if upper:
+            upper = upper[:-1] + chr(ord(upper[-1]) + 1)
+            rows = self.execute('SELECT subkey FROM items WHERE key = ? AND subkey >= ? AND '
+                                'subkey < ? ORDER BY subkey LIMIT ?',
+                                (key_id, prefix, upper, limit))
+        else:
+            rows = self.execute('SELECT subkey FROM items WHERE key = ? AND subkey >= ? '
+                                'ORDER BY subkey LIMIT ?', (key_id, prefix, limit))
+        return [row[0] for row in rows]
+
+    def merge(self, d):
+        """Merge dict into storage the way merge_recurse_inplace does"""
+        for key, value in d.iteritems():
+            key_id = self.get_id(key)
+            row = self.execute('SELECT data FROM keys WHERE id = ?', (key_id,)).fetchone()
+            if isinstance(value, dict) and (row is None or row[0] is None):
+                if row is None:
+                    self.execute('INSERT INTO keys VALUES (?, NULL)', (key_id,))
+                for subkey, subvalue in value.iteritems():
+                    self.merge_item(key, subkey, subvalue)
+            elif row is not None and row[0] is not None:
+                merged = {key: loads(row[0])}
+                merge_recurse_inplace(merged, {key: value})
+                self[key] = merged[key]
+            else:
+                self[key] = value
+
+    def merge_item(self, key, subkey, value):
+        if subkey == REFS and isinstance(value, list):
+            self.add_refs(key, value)
+            return
+        if key in self.USR_LIST_KEYS:
+            # merged as ids, without reading names of those stored
+            key_id = self.get_id(key)
+            row = self.execute('SELECT data FROM items WHERE key = ? AND subkey = ?',
+                               (key_id, subkey)).fetchone()
+            ids = self.unpack_ids(row[0]) if row else []
+            members = set(ids)
+            for id in [self.get_id(usr) for usr in value]:
+                if id not in members:
+                    members.add(id)
+                    ids.append(id)
+            self.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?)',
+                         (key_id, subkey, self.pack_ids(ids)))
+            return
+        if self.has_item(key, subkey):
+            merged = {subkey: self.get_item(key, subkey)}
+            merge_recurse_inplace(merged, {subkey: value})
+            value = merged[subkey]
+        self.set_item(key, subkey, value)
+
+    def __del__(self):
+        if self.conn:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+    def close(self):
+        self.__del__()
+
+    def sync(self):
+        self.conn.commit()
+
+# suffixes of files a shelve database named filename may consist of
+SHELVE_SUFFIXES = ('', '.db', '.dat', '.dir', '.bak', '.pag')
+
+def open_storage(filename, flag='c', *args, **kwargs):
+    """Open storage of filename as SqliteStorage
+
+    A database written by ShelveStorage is still read as it is, but one
+    opened to write is replaced by a new SqliteStorage and parsed again,
+    as for an old schema.
+    """
+    if whichdb.whichdb(filename):
+        if flag == 'r':
+            return ShelveStorage(filename, flag, *args, **kwargs)
+        logging.warning('{} is a shelve database, it is parsed again'.format(filename))
+        for suffix in SHELVE_SUFFIXES:
+            if os.path.exists(filename + suffix):
+                os.remove(filename + suffix)
+    return SqliteStorage(filename, flag, *args, **kwargs)
@@ -2,29 +2,64 @@
 
 """
 
+import functools
+import hashlib
+import instrument
 import logging
+import os
 import time
 
+def describe_args(args, width=70):
+    "Return first plain argument found in args as string of at most width"
+    arg = args
+    while isinstance(arg, (list, tuple)) and arg:
+        arg = arg[0]
+    if not isinstance(arg, (str, int, float)):
+        return ''
+    arg = str(arg)
+    if len(arg) > width:
+        arg = arg[:width - 3]
+    return arg
+
 def measure(func, *args, **kwargs):
+    "Record each call of func as phase of its name in instrument"
+    @functools.wraps(func)
     def start(*args, **kwargs):
         begin = time.time()
-        result = func(*args, **kwargs)
+        with instrument.phase(func.__name__):
+            result = func(*args, **kwargs)
         end = time.time()
 
-        arg = args
-        while not (isinstance(arg, str) or isinstance(arg, int) or isinstance(arg, float)):
-            if isinstance(arg, list) or isinstance(arg, tuple):
-                arg = arg[0]
-            elif isinstance(args, dict):
-                arg = ''
-            else:
-                arg = ''
-
-        arg_trun = arg
-        if len(arg) > 70:
-            arg_trun = arg[:67]
         logging.info('{} took {:6.3f} sec {}'.format(func.__name__ ,
-                                                     end - begin, arg_trun))
+                                                     end - begin, describe_args(args)))
         logging.debug('with {} and {}'.format(args, kwargs))
         return result
     return start
+
+def file_digest(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def stat_mtime_ns(st):
+    return getattr(st, 'st_mtime_ns', None) or int(st.st_mtime * 1000000000)
+
+def file_state(filename):
+    """Return (size, mtime_ns, digest) of filename"""
+    st = os.stat(filename)
+    return (st.st_size, stat_mtime_ns(st), file_digest(filename))
+
+def file_changed(state, filename):
+    """Return True if content of filename differs from state
+
+    Content is hashed only when size is same but mtime is not.
+    """
+    size, mtime_ns, digest = state
+    st = os.stat(filename)
+    if st.st_size != size:
+        return True
+    if stat_mtime_ns(st) == mtime_ns:
+        return False
+    return file_digest(filename) != digest
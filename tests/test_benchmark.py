@@ -0,0 +1,41 @@
+"""Unittest for benchmark
+
+"""
+
+from stags.benchmark import benchmark_project, check_project, compare
+from stags.common import libclang_set_library_file
+from unittest import TestCase
+import json
+import shutil
+import tempfile
+
+class TestBenchmark(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        try:
+            libclang_set_library_file()
+        except Exception:
+            pass
+
+    def test_benchmark_project(self):
+        basedir = tempfile.mkdtemp() + '/'
+        self.addCleanup(shutil.rmtree, basedir)
+        config = {'sources': 2, 'headers': 2, 'depth': 2, 'templates': 1, 'functions': 2}
+        report = benchmark_project(basedir, config, queries=10)
+        report = json.loads(json.dumps(report))
+
+        self.assertEqual(report['config'], config)
+        self.assertEqual(report['counts']['sources'], 2)
+        self.assertIn('include/h0.h', report['headers'])
+        for name in ('scan', 'parse_all', 'merge_recurse_inplace', 'storage_write',
+                     'query_Definition', 'query_ClassHierarchy'):
+            self.assertIn(name, report['timings'])
+
+        lines = compare(report, report)
+        self.assertEqual(len(lines), len(report['timings']))
+
+    def test_check_project(self):
+        config = {'sources': 2, 'headers': 1, 'depth': 2, 'templates': 0, 'functions': 2}
+        # parse of a source whose headers were not found
+        with self.assertRaises(RuntimeError):
+            check_project({'src/s0.cpp': {}}, config)
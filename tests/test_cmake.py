@@ -11,11 +11,35 @@ import sys
 from stags.common import *
 from stags.query import query_class_hierarchy, query, Query
 from stags.storage import ShelveStorage as Storage
+from stags.storage import SqliteStorage
 from stags.parser import remove, parse
+from stags.util import file_state
 
+import UserDict
+import json
 import logging
+import shutil
+import tempfile
 import time
 
+class Counting(UserDict.DictMixin):
+    "Mapping recording keys read, and None for reading all items"
+
+    def __init__(self, d):
+        self.d = d
+        self.reads = []
+
+    def __getitem__(self, key):
+        self.reads.append(key)
+        return self.d[key]
+
+    def keys(self):
+        return self.d.keys()
+
+    def iteritems(self):
+        self.reads.append(None)
+        return self.d.iteritems()
+
 class TestCmake(TestCase):
     @classmethod
     def setUpClass(cls):
@@ -48,7 +72,7 @@ class TestCmake(TestCase):
         pp.pprint(p)
         return p[self.basename(filename)][locus][TEMPLATE_USR]
 
-    def run_dir(self, name, filter = None):
+    def run_dir(self, name, filter = None, storage = None, **kwargs):
         basedir = os.path.abspath('tests/{}'.format(name))
         if not basedir.endswith('/'):
             basedir += '/'
@@ -73,7 +97,30 @@ class TestCmake(TestCase):
         files = proj.scan()
         if filter:
             files = [x for x in files if filter(x[0])]
-        return (proj.parse_all(files), basedir)
+        return (proj.parse_all(files, storage, **kwargs), basedir)
+
+    def make_project(self, contents, commands):
+        """Return Project of a temporary directory holding contents
+
+        contents maps names of files to their content and commands maps
+        names of sources to their compiler flags.
+        """
+        basedir = tempfile.mkdtemp() + '/'
+        self.addCleanup(shutil.rmtree, basedir)
+        builddir = os.path.join(basedir, 'build')
+        os.mkdir(builddir)
+        for name, content in contents.iteritems():
+            with open(basedir + name, 'w') as f:
+                f.write(content)
+        self.write_commands(builddir, commands)
+        return Project(builddir, basedir)
+
+    @staticmethod
+    def write_commands(builddir, commands):
+        with open(os.path.join(builddir, 'compile_commands.json'), 'w') as f:
+            json.dump([{'directory': builddir, 'file': '../' + name,
+                        'command': 'c++ {} -c ../{}'.format(flags, name)}
+                       for name, flags in sorted(commands.iteritems())], f)
 
     def patch_file(self, name, patch):
         basedir = os.path.abspath('tests/{}'.format(name))
@@ -157,6 +204,424 @@ class TestClass(TestCmake):
             expected = self.filename_locus(s[dst_file], dst_locus)
             self.assertEqual(expected, self.basedir + actual)
 
+class TestNames(TestCmake):
+    def test_names(self):
+        filename = sys._getframe().f_code.co_name + '.db'
+        d = SqliteStorage(filename, 'n')
+        self.run_dir('test_class', storage=d)
+
+        self.assertEqual(query(Query.Completion, 'Ba', d), ['Base'])
+        self.assertEqual(query(Query.Completion, 'meth', d), ['method1'])
+        self.assertEqual(sorted(query(Query.Name, 'ase', d)), ['base.h:4:7'])
+        self.assertEqual(sorted(query(Query.Name, 'method', d)),
+                         ['base.cpp:3:12', 'derived.cpp:3:15'])
+
+        # declaration when definition is removed
+        remove(d, 'base.cpp')
+        self.assertEqual(sorted(query(Query.Name, 'method', d)),
+                         ['base.h:6:18', 'derived.cpp:3:15'])
+
+        d.close()
+        os.remove(filename)
+
+    def test_names_written(self):
+        filename = sys._getframe().f_code.co_name + '.db'
+        d = SqliteStorage(filename, 'n')
+        self.run_dir('test_class', storage=d)
+        d.sync()
+
+        # as by a query server keeping the database open
+        reader = SqliteStorage(filename, 'r')
+        self.assertEqual(query(Query.Completion, 'Ba', reader), ['Base'])
+        self.assertEqual(query(Query.Name, 'Bar', reader), [])
+
+        batch = {NAMES: {'Bar': ['c:@S@Bar']}, 'c:@S@Bar': {DECL: 'bar.h:1:7', SPELL: 'Bar'}}
+        Project.update(d, batch, set(), set())
+        d.sync()
+        self.assertEqual(query(Query.Completion, 'Ba', reader), ['Bar', 'Base'])
+        # substring search rebuilds its index
+        self.assertEqual(query(Query.Name, 'Bar', reader), ['bar.h:1:7'])
+
+        self.assertEqual(query(Query.Completion, 'mai', reader), ['main'])
+        remove(d, 'main.cpp')
+        d.sync()
+        self.assertEqual(query(Query.Completion, 'mai', reader), [])
+
+        reader.close()
+        d.close()
+        os.remove(filename)
+
+    def test_names_removed(self):
+        parsed_dict, _ = self.run_dir('test_class')
+        p = parsed_dict
+        self.assertIn('main', p[NAMES])
+        remove(p, 'main.cpp')
+        self.assertNotIn('main', p[NAMES])
+
+class TestOutline(TestCmake):
+    def test_outline(self):
+        from stags.query import query_lines
+        filename = sys._getframe().f_code.co_name + '.db'
+        d = SqliteStorage(filename, 'n')
+        self.run_dir('test_class', storage=d)
+        s = self.sources
+
+        self.assertEqual(query(Query.Outline, s['base.h'], d),
+                         [(4, 7, 'CLASS_DECL', 'Base'), (6, 18, 'CXX_METHOD', 'method1')])
+        self.assertEqual(query(Query.Outline, s['base.h'] + ':5:9', d),
+                         [(6, 18, 'CXX_METHOD', 'method1')])
+        self.assertEqual(query(Query.Outline, s['base.h'] + ':10:20', d), [])
+        self.assertEqual(query_lines(Query.Outline, s['base.h'] + ':1:4', d),
+                         ['{}:4:7:CLASS_DECL Base'.format(s['base.h'])])
+
+        remove(d, 'base.h')
+        with self.assertRaises(KeyError):
+            query(Query.Outline, s['base.h'], d)
+
+        d.close()
+        os.remove(filename)
+
+    def test_outline_sorted(self):
+        parsed_dict, _ = self.run_dir('test_class')
+        outlines = parsed_dict[OUTLINES]
+        self.assertEqual(sorted(outlines), ['base.cpp', 'base.h', 'derived.cpp', 'derived.h', 'main.cpp'])
+        for outline in outlines.values():
+            self.assertEqual(outline, sorted(set(outline)))
+
+class TestNearestLocus(TestCmake):
+    def test_inside_token(self):
+        filename = sys._getframe().f_code.co_name + '.db'
+        d = SqliteStorage(filename, 'n')
+        self.run_dir('test_class', storage=d)
+        main = self.sources['main.cpp']
+
+        # d->method1("hello"); method1 spans columns 8 to 14
+        for column in (8, 11, 14):
+            self.assertEqual(query(Query.Definition, '{}:6:{}'.format(main, column), d),
+                             'derived.cpp:3:15')
+        with self.assertRaises(KeyError):
+            query(Query.Definition, '{}:6:15'.format(main), d)
+
+        # Derived *d = new Derived;
+        self.assertEqual(query(Query.Definition, '{}:5:11'.format(main), d), 'derived.h:6:7')
+        self.assertEqual(query(Query.Definition, '{}:5:25'.format(main), d), 'derived.h:6:7')
+
+        d.close()
+        os.remove(filename)
+
+    def test_spans_sorted(self):
+        parsed_dict, _ = self.run_dir('test_class')
+        spans = parsed_dict[SPANS]
+        self.assertIn((6, 8, 15), spans['main.cpp'])
+        for value in spans.values():
+            self.assertEqual(value, sorted(set(value)))
+
+        remove(parsed_dict, 'main.cpp')
+        self.assertNotIn('main.cpp', parsed_dict[SPANS])
+
+class TestHierarchy(TestCmake):
+    def test_hierarchy(self):
+        filename = sys._getframe().f_code.co_name + '.db'
+        d = SqliteStorage(filename, 'n')
+        self.run_dir('test_graph', storage=d)
+        main = self.sources['main.cpp']
+
+        hierarchy = d[HIERARCHY]
+        self.assertEqual(hierarchy['c:@S@Derived'], {
+            ANCESTORS: ['c:@S@Base', 'c:@S@Delegate'],
+            DESCENDANTS: ['c:@S@MoreDerived']})
+        self.assertEqual(hierarchy['c:@S@Base'], {
+            ANCESTORS: [],
+            DESCENDANTS: ['c:@S@Derived', 'c:@S@MoreDerived']})
+
+        self.assertEqual(d['c:@S@Derived@F@method1#*1C#'][OVERRIDES],
+                         ['c:@S@Base@F@method1#*1C#'])
+        self.assertEqual(d['c:@S@Delegate@F@didStarted#'][OVERRIDDEN_BY],
+                         ['c:@S@Derived@F@didStarted#'])
+        self.assertEqual(hierarchy['c:@S@Derived@F@method1#*1C#'], {
+            ANCESTORS: ['c:@S@Base@F@method1#*1C#'],
+            DESCENDANTS: ['c:@S@MoreDerived@F@method1#*1C#']})
+
+        # m->method1(msg) of MoreDerived and b->method1("hello") of Base
+        self.assertEqual(sorted(query(Query.ReferenceInherit, main + ':26:8', d)),
+                         ['main.cpp:26:8', 'main.cpp:32:8'])
+        self.assertEqual(query_class_hierarchy(main, '6:7', d, export_as='text'),
+                         set([('MoreDerived', 'class Derived'),
+                              ('class Derived', 'class Base'),
+                              ('class Derived', 'class Delegate')]))
+
+        d.close()
+        os.remove(filename)
+
+    def test_hierarchy_batch(self):
+        from stags.query import query_batch
+        method = 'c:@S@B@F@run#'
+        hierarchy = Counting(dict(
+            (usr, {ANCESTORS: [], DESCENDANTS: []}) for usr in
+            ('c:@S@A@F@run#', 'c:@S@C@F@run#', 'c:@S@D@F@run#')))
+        hierarchy.d[method] = {ANCESTORS: ['c:@S@A@F@run#'], DESCENDANTS: ['c:@S@C@F@run#']}
+        basedir = tempfile.mkdtemp() + '/'
+        self.addCleanup(shutil.rmtree, basedir)
+        with open(basedir + 'a.cpp', 'w') as f:
+            f.write('a\nb\nc\n')
+        p = {
+            'basedir': basedir,
+            'a.cpp': {'1:1': {REF_USR: method}},
+            method: {KIND: 'CXX_METHOD', REFS: ['a.cpp:1:1']},
+            'c:@S@A@F@run#': {KIND: 'CXX_METHOD', REFS: ['a.cpp:2:1']},
+            'c:@S@C@F@run#': {KIND: 'CXX_METHOD', REFS: ['a.cpp:3:1']},
+            HIERARCHY: hierarchy,
+        }
+        results = list(query_batch([(Query.ReferenceInherit, basedir + 'a.cpp:1:1')], p))
+        self.assertEqual(len(results[0][2]), 3)
+        # only the closure of the method is read
+        self.assertEqual(hierarchy.reads, [method])
+
+    def test_hierarchy_removed(self):
+        from stags.parser import update_hierarchy
+        parsed_dict, _ = self.run_dir('test_class')
+        p = parsed_dict
+        self.assertEqual(p[HIERARCHY]['c:@S@Base'][DESCENDANTS], ['c:@S@Derived'])
+
+        base_method = 'c:@S@Base@F@method1#*1C#'
+        derived_method = 'c:@S@Derived@F@method1#*1C#'
+        self.assertEqual(p[HIERARCHY][base_method][DESCENDANTS], [derived_method])
+
+        touched = set()
+        remove(p, 'derived.h', touched)
+        update_hierarchy(p, touched)
+        self.assertNotIn('c:@S@Base', p[HIERARCHY])
+        self.assertNotIn('c:@S@Derived', p[HIERARCHY])
+        # still defined in derived.cpp
+        self.assertEqual(p[derived_method][OVERRIDES], [base_method])
+
+        touched = set()
+        remove(p, 'derived.cpp', touched)
+        update_hierarchy(p, touched)
+        # still referenced in main.cpp
+        self.assertNotIn(OVERRIDES, p[derived_method])
+        self.assertEqual(p[base_method].get(OVERRIDDEN_BY, []), [])
+        self.assertNotIn(base_method, p[HIERARCHY])
+
+class TestBatch(TestCmake):
+    def test_batch(self):
+        from StringIO import StringIO
+        from stags.query import serve_batch
+        filename = sys._getframe().f_code.co_name + '.db'
+        d = SqliteStorage(filename, 'n')
+        self.run_dir('test_class', storage=d)
+        s = self.sources
+
+        requests = [
+            'Definition {}:6:18'.format(s['base.h']),
+            'Definition {}:6:8'.format(s['main.cpp']),
+            'Bogus {}:6:8'.format(s['main.cpp']),
+            'Declaration {}:6:8'.format(s['main.cpp']),
+            'Definition {}:1:1'.format(s['base.h']),
+            'Completion Ba',
+        ]
+        wfile = StringIO()
+        serve_batch(d, StringIO('\n'.join(requests) + '\n'), wfile)
+        lines = wfile.getvalue().splitlines()
+
+        self.assertIn("ERR Bogus {}:6:8 KeyError('Bogus',)".format(s['main.cpp']), lines)
+        # grouped by file
+        main = lines.index('OK 1 Definition {}:6:8'.format(s['main.cpp']))
+        self.assertTrue(lines[main + 1].startswith(s['derived.cpp'] + ':3:15:'))
+        self.assertEqual(lines[main + 2], 'OK 1 Declaration {}:6:8'.format(s['main.cpp']))
+        base = lines.index('OK 1 Definition {}:6:18'.format(s['base.h']))
+        self.assertTrue(lines[base + 1].startswith(s['base.cpp'] + ':3:12:'))
+        self.assertTrue(lines[base + 2].startswith('ERR Definition {}:1:1'.format(s['base.h'])))
+        self.assertEqual(lines[-2:], ['OK 1 Completion Ba', 'Base'])
+
+        d.close()
+        os.remove(filename)
+
+    def test_batch_view(self):
+        from stags.query import BatchView
+        symbol = Counting({DEFI: 'a.h:1:1', REFS: ['a.cpp:2:3'] * 1000})
+        view = BatchView({'c:@S@A': symbol})
+        for i in range(3):
+            self.assertEqual(view['c:@S@A'][DEFI], 'a.h:1:1')
+        # REFS are not read for a definition
+        self.assertEqual(symbol.reads, [DEFI])
+        self.assertEqual(dict(view['c:@S@A'])[DEFI], 'a.h:1:1')
+        self.assertEqual(symbol.reads, [DEFI, None])
+
+class TestServer(TestCmake):
+    def test_serve(self):
+        from StringIO import StringIO
+        from stags.query import serve
+        p, _ = self.run_dir('test_class')
+        s = self.sources
+
+        requests = [
+            'Definition {}:6:8'.format(s['main.cpp']),
+            '',
+            'Bogus {}:6:8'.format(s['main.cpp']),
+            'Definition {}:1:1'.format(s['base.h']),
+            'Completion Ba',
+        ]
+        wfile = StringIO()
+        serve(p, StringIO('\n'.join(requests) + '\n'), wfile)
+        lines = wfile.getvalue().splitlines()
+
+        self.assertEqual(lines[0], 'OK 1')
+        self.assertTrue(lines[1].startswith(s['derived.cpp'] + ':3:15:'))
+        self.assertEqual(lines[2], "ERR KeyError('Bogus',)")
+        self.assertTrue(lines[3].startswith('ERR '))
+        self.assertEqual(lines[4:], ['OK 1', 'Base'])
+
+    def test_query_server(self):
+        import threading
+        from stags import client
+        from stags.query import QueryServer
+        p, _ = self.run_dir('test_class')
+        s = self.sources
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'stags.sock')
+        # a socket left by a server killed before is replaced
+        open(path, 'w').close()
+        server = QueryServer(path, p)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            ok, lines = client.request(path, 'Definition', '{}:6:8'.format(s['main.cpp']))
+            self.assertTrue(ok)
+            self.assertEqual(len(lines), 1)
+            self.assertTrue(lines[0].startswith(s['derived.cpp'] + ':3:15:'))
+            self.assertEqual(client.request(path, 'Completion', 'Ba'), (True, ['Base']))
+            ok, lines = client.request(path, 'Bogus', '{}:6:8'.format(s['main.cpp']))
+            self.assertFalse(ok)
+            self.assertEqual(lines, ["ERR KeyError('Bogus',)"])
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+        self.assertFalse(os.path.exists(path))
+
+class TestParseIntoStorage(TestCmake):
+    def test_parse_into_storage(self):
+        filename = sys._getframe().f_code.co_name + '.db'
+        d = SqliteStorage(filename, 'n')
+        parsed_dict, _ = self.run_dir('test_class', storage=d, batch_size=1)
+        self.assertIs(parsed_dict, d)
+
+        s = self.sources
+        p = parsed_dict
+
+        self.is_declaration_of(p, self.ref_usr, s['main.cpp'], '6:8', s['derived.h'], '8:18')
+        self.is_definition_of(p, self.ref_usr, s['main.cpp'], '6:8', s['derived.cpp'], '3:15')
+        self.is_baseclass_of(p, s['base.h'], '4:7', s['derived.h'], '6:7')
+        self.assertIn(s['main.cpp'], p[FILES])
+
+        d.close()
+        os.remove(filename)
+
+class TestIndexedFiles(TestCmake):
+    def test_header_indexed_once(self):
+        self.run_dir('test_class')
+        s = self.sources
+
+        indexed = {}
+        derived = parse(s['derived.cpp'], '-x', 'c++', basedir=self.basedir, indexed_files=indexed)
+        main = parse(s['main.cpp'], '-x', 'c++', basedir=self.basedir, indexed_files=indexed)
+
+        self.assertIn('derived.h', derived)
+        self.assertIn('base.h', derived)
+        self.assertNotIn('derived.h', main)
+        self.assertNotIn('base.h', main)
+        self.assertIn('6:8', main['main.cpp'])
+
+    def test_header_after_define(self):
+        proj = self.make_project({
+            'h.h': '#ifdef USE_A\nint fa();\n#endif\n#ifndef USE_A\nint fb();\n#endif\n',
+            'a.cpp': '#define USE_A\n#include "h.h"\nint main() { return fa(); }\n',
+            'b.cpp': '#include "h.h"\nint main() { return fb(); }\n',
+        }, {'a.cpp': '', 'b.cpp': ''})
+        p = proj.parse_all_single(proj.scan())
+        self.assertEqual(p['c:@F@fa#'][DECL], 'h.h:2:5')
+        self.assertEqual(p['c:@F@fb#'][DECL], 'h.h:5:5')
+        self.assertEqual(query(Query.Definition, proj.basedir + 'b.cpp:2:21', p), 'h.h:5:5')
+
+    def test_inclusion_lines(self):
+        from stags.parser import get_inclusion_lines
+        inclusions = [('g.h', 'h.h', 1), ('a.cpp', 'g.h', 3), ('a.cpp', 'x.h', 1),
+                      ('x.h', 'h.h', 2)]
+        self.assertEqual(get_inclusion_lines('a.cpp', inclusions),
+                         {'g.h': 3, 'x.h': 1, 'h.h': 1})
+
+class TestPrunedTraversal(TestCmake):
+    def test_system_headers_pruned(self):
+        import shutil
+        import tempfile
+        from stags.parser import get_file_keys
+        basedir = tempfile.mkdtemp() + '/'
+        self.addCleanup(shutil.rmtree, basedir)
+        filename = os.path.join(basedir, 'a.cpp')
+        with open(filename, 'w') as f:
+            f.write('#include <string>\n'
+                    '#include <stdio.h>\n'
+                    'int main() { std::string s; printf("%s", s.c_str()); }\n')
+
+        p = parse(filename, '-x', 'c++', basedir=basedir)
+        self.assertEqual(get_file_keys(p), ['a.cpp'])
+        self.assertIn('c:@F@main#', p)
+        self.assertIn('c:@N@std@T@string', p)
+
+class TestSharedIndex(TestCmake):
+    def test_index_shared(self):
+        from stags import parser
+        self.run_dir('test_class')
+        s = self.sources
+        parse(s['main.cpp'], '-x', 'c++', basedir=self.basedir)
+        index = parser.get_index()
+        parse(s['base.cpp'], '-x', 'c++', basedir=self.basedir)
+        self.assertIs(parser.get_index(), index)
+
+class TestReparse(TestCmake):
+    def test_reparse(self):
+        from stags import parser
+        self.run_dir('test_class')
+        s = self.sources
+
+        first = parse(s['main.cpp'], '-x', 'c++', basedir=self.basedir, reparse=True)
+        self.assertEqual(len([k for k in parser.translation_units if k[0] == s['main.cpp']]), 1)
+
+        with open(s['base.h']) as f:
+            content = f.read()
+        def restore():
+            with open(s['base.h'], 'w') as f:
+                f.write(content)
+        self.addCleanup(restore)
+        with open(s['base.h'], 'a') as f:
+            f.write('int reparsed_function();\n')
+
+        second = parse(s['main.cpp'], '-x', 'c++', basedir=self.basedir, reparse=True)
+        self.assertEqual(len([k for k in parser.translation_units if k[0] == s['main.cpp']]), 1)
+        self.assertNotIn('c:@F@reparsed_function#', first)
+        self.assertIn('c:@F@reparsed_function#', second)
+        self.assertEqual(first['main.cpp'], second['main.cpp'])
+
+    def test_update_modified(self):
+        from stags import parser
+        proj = self.make_project({'a.cpp': 'int first();\n'}, {'a.cpp': ''})
+        a = proj.basedir + 'a.cpp'
+        d = SqliteStorage(os.path.join(proj.basedir, 'stags.db'), 'n')
+        self.assertEqual([a], [x[0] for x in proj.update_modified(d, reparse=True)])
+        tus = [tu for k, tu in parser.translation_units.iteritems() if k[0] == a]
+        self.assertEqual(len(tus), 1)
+
+        with open(a, 'a') as f:
+            f.write('int second();\n')
+        self.assertEqual([a], [x[0] for x in proj.update_modified(d, reparse=True)])
+        self.assertEqual(tus, [tu for k, tu in parser.translation_units.iteritems() if k[0] == a])
+        self.assertEqual(d['c:@F@second#'][DECL], 'a.cpp:2:5')
+        self.assertEqual([], proj.update_modified(d, reparse=True))
+        d.close()
+
 class TestClassMemberVariable(TestCmake):
     def test_class_member_variable(self):
         parsed_dict, _ = self.run_dir(sys._getframe().f_code.co_name)
@@ -204,8 +669,10 @@ class TestRemove(TestCmake):
         p = parsed_dict
         person_usr = self.usr(p, self.basename(self.sources['person.h']), '4:7')
         person_talk_usr = self.usr(p, self.basename(self.sources['person.h']), '6:10')
+        self.assertIn(person_usr, p[FILE_USRS]['person.h'])
         remove(p, 'person.h')
         self.assertFalse(p.has_key('person.h'))
+        self.assertNotIn('person.h', p[FILE_USRS])
         self.assertNotIn(DEFI, p[person_usr])
         self.assertNotIn(DECL, p[person_talk_usr])
 
@@ -274,6 +741,130 @@ class TestRemove(TestCmake):
 
         os.remove(filename)
 
+    def test_incremental_update(self):
+        name = 'test_remove_and_update'
+        src = 'person.h'
+
+        basedir = os.path.abspath('tests/{}'.format(name)) + '/'
+        import shutil
+        shutil.copyfile(os.path.join(basedir, src + '.orig'), os.path.join(basedir, src))
+
+        filename = sys._getframe().f_code.co_name + '.db'
+        d = SqliteStorage(filename, 'n')
+        self.run_dir(name, storage=d)
+        person_usr = self.usr(d, src, '4:7')
+        talk_usr = self.usr(d, src, '6:10')
+
+        self.patch_file(name, src + '.patch')
+        modified = self.proj.scan_modified(self.proj.scan(), dict(d[FILES]))
+        self.proj.parse_all(modified, d)
+
+        s = self.sources
+        self.assertNotIn('4:7', d[src])
+        self.assertNotIn('6:10', d[src])
+        self.assertEqual(self.usr(d, src, '5:7'), person_usr)
+        self.is_definition_of(d, self.usr, s[src], '5:7', s[src], '5:7')
+        self.is_definition_of(d, self.usr, s[src], '8:10', s['person.cpp'], '3:14')
+        self.assertEqual(d[talk_usr][DECL], 'person.h:8:10')
+        self.assertIn(talk_usr, d[FILE_USRS][src])
+        for usr in (person_usr, talk_usr):
+            refs = d[usr].get(REFS, [])
+            self.assertEqual(len(refs), len(set(refs)))
+            self.assertFalse([ref for ref in refs if ref.startswith(src + ':4:')])
+
+        d.close()
+        os.remove(filename)
+
+    def test_update_shared_header(self):
+        from stags import parser
+        # h.h is parsed on its own with the flags of h.cpp
+        proj = self.make_project({
+            'h.h': '#ifdef USE_A\nint fa();\n#endif\n#ifdef USE_B\nint fb();\n#endif\n',
+            'h.cpp': '#include "h.h"\nint main() { return fa(); }\n',
+            'b.cpp': '#include "h.h"\nint main() { return fb(); }\n',
+        }, {'h.cpp': '-DUSE_A', 'b.cpp': '-DUSE_B'})
+        basedir = proj.basedir
+
+        d = SqliteStorage(os.path.join(basedir, 'stags.db'), 'n')
+        proj.parse_all(proj.scan(), d)
+        self.assertEqual(d['c:@F@fb#'][DECL], 'h.h:5:5')
+
+        # b.cpp is not parsed again when only h.cpp changed
+        with open(basedir + 'h.cpp', 'a') as f:
+            f.write('// modified\n')
+        modified = proj.scan_modified(proj.scan(), dict(d[FILES]))
+        self.assertEqual([basedir + 'h.cpp'], [x[0] for x in modified])
+        proj.parse_all(modified, d)
+        self.assertEqual(d['c:@F@fa#'][DECL], 'h.h:2:5')
+        self.assertEqual(d['c:@F@fb#'][DECL], 'h.h:5:5')
+        self.assertEqual(d['h.h']['5:5'][USR], 'c:@F@fb#')
+        self.assertIn('c:@F@fb#', d[FILE_USRS]['h.h'])
+
+        # nor when only the header is parsed again
+        proj.header_profile = parser.FULL
+        modified = proj.scan_modified(proj.scan(), dict(d[FILES]))
+        self.assertEqual([basedir + 'h.h'], [x[0] for x in modified])
+        proj.parse_all(modified, d)
+        self.assertEqual(d['c:@F@fa#'][DECL], 'h.h:2:5')
+        self.assertEqual(d['c:@F@fb#'][DECL], 'h.h:5:5')
+        d.close()
+
+    def test_update_source_emptied(self):
+        proj = self.make_project({'a.cpp': 'int old_function() { return 0; }\n'},
+                                 {'a.cpp': ''})
+        d = SqliteStorage(os.path.join(proj.basedir, 'stags.db'), 'n')
+        proj.parse_all(proj.scan(), d)
+        self.assertEqual(d['c:@F@old_function#'][DEFI], 'a.cpp:1:5')
+
+        with open(proj.basedir + 'a.cpp', 'w') as f:
+            f.write('// nothing left\n')
+        modified = proj.scan_modified(proj.scan(), dict(d[FILES]))
+        proj.parse_all(modified, d)
+        self.assertNotIn('c:@F@old_function#', d)
+        self.assertNotIn('a.cpp', d)
+        self.assertNotIn('old_function', d[NAMES])
+        d.close()
+
+    def test_update_source_unscanned(self):
+        proj = self.make_project({
+            'h.h': '#ifdef USE_B\nint only_b();\n#endif\nint kept();\nint gone();\n',
+            'a.cpp': '#include "h.h"\nint main() { return kept(); }\n',
+            'b.cpp': '#include "h.h"\nint main() { return gone(); }\n',
+            'c.cpp': 'int c() { return 0; }\n',
+        }, {'a.cpp': '', 'b.cpp': '-DUSE_B', 'c.cpp': ''})
+        basedir = proj.basedir
+        d = SqliteStorage(os.path.join(basedir, 'stags.db'), 'n')
+        proj.parse_all(proj.scan(), d)
+        self.assertEqual(d['c:@F@only_b#'][DECL], 'h.h:2:5')
+
+        self.write_commands(proj.builddir, {'a.cpp': '', 'c.cpp': ''})
+        with open(basedir + 'h.h', 'w') as f:
+            f.write('int kept();\n')
+        scanned_list = proj.scan()
+        proj.remove_unscanned(d, scanned_list)
+        self.assertNotIn(basedir + 'b.cpp', d[FILES])
+        # a.cpp wrote h.h too, so it is parsed again
+        modified = proj.scan_modified(scanned_list, dict(d[FILES]))
+        self.assertEqual([basedir + 'a.cpp'], [x[0] for x in modified])
+        proj.parse_all(modified, d)
+        self.assertNotIn('b.cpp', d)
+        self.assertNotIn('c:@F@gone#', d)
+        self.assertNotIn('c:@F@only_b#', d)
+        self.assertEqual(d['c:@F@kept#'][DECL], 'h.h:1:5')
+        d.close()
+
+    def test_shared_file_changed(self):
+        proj = self.make_project({'h.h': 'int f();\n'}, {})
+        h, a, b = [proj.basedir + name for name in ('h.h', 'a.cpp', 'b.cpp')]
+        files = {h: {STATE: file_state(h)},
+                 a: {PROFILE: 'full', INCLUDES: (h,)},
+                 b: {PROFILE: 'full', INCLUDES: (h,)}}
+        self.assertEqual(set(['h.h', 'b.cpp']), proj.get_shared_files(files, [a]))
+
+        with open(h, 'w') as f:
+            f.write('int g();\n')
+        self.assertEqual(set(['b.cpp']), proj.get_shared_files(files, [a]))
+
 class TestModified(TestCmake):
     TEST_DIR = 'test_modified'
 
@@ -282,6 +873,16 @@ class TestModified(TestCmake):
         with open(filename, 'a'):
             os.utime(filename, None)
 
+    def modify(self, filename):
+        with open(filename) as f:
+            content = f.read()
+        def restore():
+            with open(filename, 'w') as f:
+                f.write(content)
+        self.addCleanup(restore)
+        with open(filename, 'a') as f:
+            f.write('// modified\n')
+
     def scan_modified(self, files):
         modified = self.proj.scan_modified(self.proj.scan(), files)
         return modified
@@ -292,7 +893,7 @@ class TestModified(TestCmake):
         files = parsed_dict[FILES]
 
         base_h = self.sources['base.h']
-        self.touch(base_h)
+        self.modify(base_h)
         modified = [x[0] for x in self.scan_modified(files)]
 
         self.assertIn(base_h, modified)
@@ -304,10 +905,82 @@ class TestModified(TestCmake):
 
         touches = ('base.h', 'base.cpp')
         for touch in touches:
+            self.modify(self.sources[touch])
+
+        modified = [x[0] for x in self.scan_modified(files)]
+
+        # base.h is included by every other file, directly or not
+        expected = [self.sources[x] for x in
+                    ('base.h', 'base.cpp', 'derived.h', 'derived.cpp', 'main.cpp')]
+        self.assertEqual(sorted(expected), sorted(modified))
+
+    def test_modified_included(self):
+        parsed_dict, _ = self.run_dir(self.TEST_DIR)
+        files = parsed_dict[FILES]
+
+        self.modify(self.sources['derived.h'])
+        modified = [x[0] for x in self.scan_modified(files)]
+
+        expected = [self.sources[x] for x in ('derived.h', 'derived.cpp', 'main.cpp')]
+        self.assertEqual(sorted(expected), sorted(modified))
+
+    def test_touched_not_modified(self):
+        parsed_dict, _ = self.run_dir(self.TEST_DIR)
+        files = parsed_dict[FILES]
+
+        time.sleep(0.01)
+        for touch in ('base.h', 'base.cpp'):
             self.touch(self.sources[touch])
 
+        self.assertEqual([], self.scan_modified(files))
+
+    def test_new_file_modified(self):
+        parsed_dict, _ = self.run_dir(self.TEST_DIR)
+        files = parsed_dict[FILES]
+
+        base_cpp = self.sources['base.cpp']
+        del files[base_cpp]
+        modified = [x[0] for x in self.scan_modified(files)]
+
+        self.assertEqual([base_cpp], modified)
+
+    def test_file_state_recorded(self):
+        parsed_dict, _ = self.run_dir(self.TEST_DIR)
+        files = parsed_dict[FILES]
+
+        for name in ('base.h', 'derived.h', 'main.cpp'):
+            filename = self.sources[name]
+            self.assertEqual(file_state(filename), files[filename][STATE])
+
+        includes = (self.sources['base.h'], self.sources['derived.h'])
+        self.assertEqual(includes, files[self.sources['main.cpp']][INCLUDES])
+
+    def test_failed_not_recorded(self):
+        batch = {}
+        Project.fold(batch, {}, '/src/a.cpp', (1, 2, 'md5'), 'full', 0.5, None)
+        self.assertNotIn('/src/a.cpp', batch.get(FILES, {}))
+
+    def test_profile_recorded(self):
+        from stags import parser
+        parsed_dict, _ = self.run_dir(self.TEST_DIR)
+        files = parsed_dict[FILES]
+        self.assertEqual(files[self.sources['base.h']][PROFILE], parser.DECLARATIONS)
+        self.assertEqual(files[self.sources['main.cpp']][PROFILE], parser.FULL)
+        self.assertEqual(self.scan_modified(files), [])
+
+        self.proj.header_profile = parser.FULL
         modified = [x[0] for x in self.scan_modified(files)]
+        self.assertEqual(sorted(modified), sorted([self.sources['base.h'], self.sources['derived.h']]))
 
-        self.assertEqual(2, len(modified))
-        for file in modified:
-            self.assertIn(file, modified)
+    def test_order_by_cost(self):
+        parsed_dict, _ = self.run_dir(self.TEST_DIR)
+        files = parsed_dict[FILES]
+        sources = self.proj.scan()
+        for src, _ in sources:
+            self.assertIn(PARSE_TIME, files[src])
+
+        slowest = sources[-1][0]
+        files[slowest][PARSE_TIME] = 1000.0
+        ordered = self.proj.order_by_cost(sources, files)
+        self.assertEqual(slowest, ordered[0][0])
+        self.assertEqual(sorted(sources), sorted(ordered))
@@ -0,0 +1,87 @@
+"""Unittest for compdb
+
+"""
+
+from StringIO import StringIO
+from stags.compdb import get_compile_commands, iter_json_array, split_command
+from stags.common import libclang_set_library_file
+from stags.project import Project, apply_parse
+from unittest import TestCase
+import json
+import os
+import shutil
+import tempfile
+
+class TestCompdb(TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp() + '/'
+        self.addCleanup(shutil.rmtree, self.basedir)
+        self.builddir = os.path.join(self.basedir, 'build')
+        os.mkdir(self.builddir)
+
+    def write(self, entries):
+        for entry in entries:
+            filename = os.path.join(entry['directory'], entry['file'])
+            base = os.path.splitext(filename)[0]
+            for name in (filename, base + '.h'):
+                open(name, 'w').close()
+        with open(os.path.join(self.builddir, 'compile_commands.json'), 'w') as f:
+            json.dump(entries, f, indent=2)
+
+    def test_iter_json_array(self):
+        entries = [{'file': 'a{}.cpp'.format(i), 'arguments': ['c++', '-DX="]"']}
+                   for i in range(20)]
+        f = StringIO(' \n' + json.dumps(entries, indent=2) + '\n')
+        f.name = 'compile_commands.json'
+        self.assertEqual(list(iter_json_array(f, chunk_size=7)), entries)
+
+    def test_split_command(self):
+        self.assertEqual(split_command('c++ -DNAME="a b" -c a.cpp'),
+                         ['c++', '-DNAME=a b', '-c', 'a.cpp'])
+        self.assertEqual(split_command('c++  -O2 a.cpp'), ['c++', '-O2', 'a.cpp'])
+
+    def test_get_compile_commands(self):
+        self.write([{'directory': self.basedir, 'file': 'a.cpp',
+                     'command': 'c++ -DNAME="a b" -c a.cpp'}])
+        commands = list(get_compile_commands(self.builddir))
+        self.assertEqual(commands, [(self.basedir, self.basedir + 'a.cpp',
+                                     ['c++', '-DNAME=a b', '-c', 'a.cpp'])])
+        self.assertIsInstance(commands[0][2][0], str)
+
+    def test_scan(self):
+        self.write([
+            {'directory': self.builddir, 'file': '../a.cpp',
+             'command': 'c++ -DNAME="a b" -o a.o -c ../a.cpp'},
+            {'directory': self.builddir, 'file': '../b.cpp',
+             'arguments': ['c++', '-DNAME=a b', '-o', 'b.o', '-c', '../b.cpp']},
+            {'directory': self.builddir, 'file': '../c.S',
+             'command': 'cc -c ../c.S'},
+        ])
+        sources = Project(self.builddir, self.basedir).scan()
+        self.assertEqual([src for src, _ in sources],
+                         [self.basedir + name for name in ('a.cpp', 'a.h', 'b.cpp', 'b.h')])
+        self.assertEqual(sources[0][1], ('-DNAME=a b', '-x', 'c++'))
+        for _, others in sources:
+            self.assertIs(others, sources[0][1])
+
+    def test_parse_scanned_arguments(self):
+        libclang_set_library_file()
+        include = os.path.join(self.basedir, 'include')
+        os.mkdir(include)
+        with open(os.path.join(include, 'h.h'), 'w') as f:
+            f.write('int from_header();\n')
+        with open(os.path.join(self.basedir, 'a.cpp'), 'w') as f:
+            f.write('#include "h.h"\n'
+                    '#ifdef NAME\n'
+                    'int defined_name();\n'
+                    '#endif\n')
+        with open(os.path.join(self.builddir, 'compile_commands.json'), 'w') as f:
+            json.dump([{'directory': self.builddir, 'file': '../a.cpp',
+                        'command': 'c++ -DNAME="a b" -I../include -c ../a.cpp'}], f)
+
+        sources = Project(self.builddir, self.basedir).scan()
+        self.assertEqual(sources[0][1][0], '-DNAME=a b')
+        result = apply_parse(sources[0], basedir=self.basedir)
+        self.assertIn('c:@F@defined_name#', result)
+        self.assertIn('c:@F@from_header#', result)
+        self.assertIn('include/h.h', result)
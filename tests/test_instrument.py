@@ -0,0 +1,90 @@
+"""Unittest for instrument
+
+"""
+
+from stags import instrument
+from stags.util import describe_args, measure
+from unittest import TestCase
+import json
+import os
+import shutil
+import tempfile
+
+class TestInstrument(TestCase):
+    def setUp(self):
+        instrument.reset()
+        self.addCleanup(instrument.reset)
+        self.addCleanup(instrument.configure, ())
+
+    def test_phase(self):
+        for i in range(3):
+            with instrument.phase('merge'):
+                pass
+        instrument.count('cursors', 10)
+        instrument.count('cursors', 5)
+
+        summary = instrument.summary()
+        merge = summary['phases']['merge']
+        self.assertEqual(merge['count'], 3)
+        self.assertEqual(sum(merge['histogram'].values()), 3)
+        self.assertLessEqual(merge['min'], merge['max'])
+        self.assertEqual(summary['counters'], {'cursors': 15})
+
+    def test_histogram(self):
+        instrument.add('parse', 0.0005)
+        instrument.add('parse', 0.003)
+        instrument.add('parse', 1000)
+        histogram = instrument.summary()['phases']['parse']['histogram']
+        self.assertEqual(histogram, {'<=0.001': 1, '<=0.004': 1, '>32.768': 1})
+
+    def test_update(self):
+        worker = instrument.Stats()
+        worker.add('apply_parse', 2.0)
+        worker.count('cursors', 7)
+        instrument.add('apply_parse', 1.0)
+        instrument.stats.update(worker)
+
+        summary = instrument.summary()
+        self.assertEqual(summary['phases']['apply_parse']['count'], 2)
+        self.assertEqual(summary['phases']['apply_parse']['max'], 2.0)
+        self.assertEqual(summary['counters']['cursors'], 7)
+
+    def test_write_summary_and_profile(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        instrument.configure(['merge'])
+        with instrument.phase('merge'):
+            sorted(range(100))
+
+        filename = os.path.join(directory, 'stats.json')
+        instrument.write_summary(filename)
+        with open(filename) as f:
+            self.assertEqual(json.load(f)['phases']['merge']['count'], 1)
+        self.assertTrue(os.path.exists(os.path.join(directory, 'stats.merge.prof')))
+
+    def test_worker_profile(self):
+        import cPickle as pickle
+        import pstats
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        instrument.configure(['apply_parse'])
+        with instrument.phase('apply_parse'):
+            sorted(range(100))
+        instrument.collect_profiles()
+        worker = pickle.loads(pickle.dumps(instrument.stats, pickle.HIGHEST_PROTOCOL))
+
+        instrument.reset()
+        instrument.stats.update(worker)
+        filename = os.path.join(directory, 'stats.json')
+        instrument.write_summary(filename)
+        profile = pstats.Stats(os.path.join(directory, 'stats.apply_parse.prof'))
+        self.assertIn(('~', 0, '<sorted>'), profile.stats)
+
+    def test_measure(self):
+        @measure
+        def scan(arg):
+            return arg
+        self.assertEqual(scan(object()).__class__, object)
+        self.assertEqual(instrument.summary()['phases']['scan']['count'], 1)
+        self.assertEqual(describe_args((object(),)), '')
+        self.assertEqual(describe_args(([('a' * 100, 1)],)), 'a' * 67)
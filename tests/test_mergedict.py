@@ -5,7 +5,7 @@
 import os
 import sys
 
-from stags.mergedict import merge_recurse_inplace
+from stags.mergedict import merge_recurse_inplace, RefList
 from stags.storage import ShelveStorage as Storage
 from unittest import TestCase, skip
 
@@ -26,6 +26,38 @@ class TestMergeRecurseInplace(TestCase):
         merge_recurse_inplace(d1, d2)
         self.assertEqual(d1, d2)
 
+    def test_hot_refs(self):
+        d1 = {'usr': {'refs': []}}
+        for i in range(1000):
+            merge_recurse_inplace(d1, {'usr': {'refs': ['file:{}:1'.format(i), 'file:1:1']}})
+        refs = d1['usr']['refs']
+        self.assertIsInstance(refs, RefList)
+        self.assertEqual(1000, len(refs))
+        self.assertEqual('file:0:1', refs[0])
+        self.assertIn('file:999:1', refs)
+
+class TestRefList(TestCase):
+    def test_unique_in_order(self):
+        refs = RefList([3, 1, 3, 2])
+        refs.append(1)
+        refs.extend([4, 2])
+        self.assertEqual([3, 1, 2, 4], refs)
+
+    def test_remove(self):
+        refs = RefList([1, 2, 3, 4])
+        refs.remove(2)
+        refs.difference_update([1, 4])
+        self.assertEqual([3], refs)
+        self.assertNotIn(1, refs)
+        refs.append(1)
+        self.assertEqual([3, 1], refs)
+
+    def test_pickled_as_list(self):
+        import cPickle as pickle
+        refs = pickle.loads(pickle.dumps(RefList([1, 2]), pickle.HIGHEST_PROTOCOL))
+        self.assertIs(type(refs), list)
+        self.assertEqual([1, 2], refs)
+
 class TestMergeRecurseInplaceWithShelveStorage(TestCase):
     def test_simple(self):
         d1 = {'file1': [1]}
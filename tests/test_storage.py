@@ -3,6 +3,7 @@
 """
 
 from stags.storage import ShelveStorage as Storage
+from stags.storage import SqliteStorage, open_storage
 from unittest import TestCase
 import os
 import sys
@@ -157,3 +158,191 @@ class TestShelveStorage(TestCase):
         d.close()
 
         os.remove(filename)
+
+class TestSqliteStorage(TestCase):
+    def test_write_and_read(self):
+        filename = sys._getframe().f_code.co_name
+        d = SqliteStorage(filename, 'n')
+        d['hello'] = 'world'
+        self.assertEqual(d['hello'], 'world')
+        d.close()
+
+        d = SqliteStorage(filename, 'r')
+        self.assertEqual(d['hello'], 'world')
+        d.close()
+
+        os.remove(filename)
+
+    def test_write_dict(self):
+        src = {'1:2': {'usr': 'c:@F@foo'}, 'refs': ['a:1:2', 'b:3:4']}
+        filename = sys._getframe().f_code.co_name
+        d = SqliteStorage(filename, 'n')
+        d['src'] = src
+        self.assertEqual(d['src']['1:2'], {'usr': 'c:@F@foo'})
+        self.assertEqual(d['src']['refs'], ['a:1:2', 'b:3:4'])
+        d.close()
+
+        d = SqliteStorage(filename, 'r')
+        self.assertEqual(dict(d['src']), src)
+        self.assertNotIn('3:4', d['src'])
+        d.close()
+
+        os.remove(filename)
+
+    def test_save_and_delitem_child_dict(self):
+        src = {'1': 2, 'child': {'3': 4, '5': 6}}
+        filename = sys._getframe().f_code.co_name
+        d = SqliteStorage(filename, 'n')
+        d.update(src)
+        d.close()
+
+        d = SqliteStorage(filename)
+        child = d['child']
+        del child['3']
+        d['child'] = child
+        d.close()
+
+        d = SqliteStorage(filename, 'r')
+        self.assertFalse(d['child'].has_key('3'))
+        self.assertEqual(d['child']['5'], 6)
+        d.close()
+
+        os.remove(filename)
+
+    def test_merge(self):
+        filename = sys._getframe().f_code.co_name
+        d = SqliteStorage(filename, 'n')
+        d.update({'file1': {'1:2': {'refs': [1]}},
+                  'usr1': {'kind': 'CXX_METHOD', 'refs': ['a:1:2']},
+                  'basedir': '/'})
+        d.merge({'file1': {'1:2': {'refs': [2]}, '5:6': {'refs': [4]}},
+                 'usr1': {'defi': 'b:3:4', 'refs': ['a:1:2', 'c:5:6']},
+                 'basedir': '/src/'})
+
+        self.assertEqual(dict(d['file1']), {'1:2': {'refs': [1, 2]},
+                                           '5:6': {'refs': [4]}})
+        self.assertEqual(dict(d['usr1']), {'kind': 'CXX_METHOD',
+                                          'defi': 'b:3:4',
+                                          'refs': ['a:1:2', 'c:5:6']})
+        self.assertEqual(d['basedir'], '/src/')
+        d.close()
+
+        os.remove(filename)
+
+    def test_interned(self):
+        filename = sys._getframe().f_code.co_name
+        d = SqliteStorage(filename, 'n')
+        d.update({'a.h': {'1:2': {'usr': 'c:@F@foo'}, '3:4': {'ref_usr': 'c:@F@foo'}},
+                  'c:@F@foo': {'decl': 'a.h:1:2', 'refs': ['a.h:3:4', 'b.cpp:5:6']}})
+        d.close()
+
+        d = SqliteStorage(filename, 'r')
+        self.assertEqual(d['a.h']['3:4'], {'ref_usr': 'c:@F@foo'})
+        self.assertEqual(d['c:@F@foo']['decl'], 'a.h:1:2')
+        self.assertEqual(d['c:@F@foo']['refs'], ['a.h:3:4', 'b.cpp:5:6'])
+        names = [row[0] for row in d.execute('SELECT name FROM names')]
+        self.assertEqual(sorted(names), ['a.h', 'b.cpp', 'c:@F@foo'])
+        d.close()
+
+        os.remove(filename)
+
+    def test_remove_refs(self):
+        filename = sys._getframe().f_code.co_name
+        d = SqliteStorage(filename, 'n')
+        d.update({'c:@F@foo': {'decl': 'a.h:1:2', 'refs': ['a.h:3:4', 'b.cpp:5:6', 'a.h']}})
+        refs_id = d.execute('SELECT rowid FROM refs WHERE line = 5').fetchone()[0]
+
+        self.assertTrue(d.remove_refs('c:@F@foo', 'a.h'))
+        self.assertEqual(d['c:@F@foo']['refs'], ['b.cpp:5:6', 'a.h'])
+        # the remaining rows are not written again
+        self.assertEqual(d.execute('SELECT rowid FROM refs WHERE line = 5').fetchone()[0],
+                         refs_id)
+
+        d.execute('DELETE FROM refs WHERE line IS NULL')
+        self.assertFalse(d.remove_refs('c:@F@foo', 'b.cpp'))
+        self.assertFalse('refs' in d['c:@F@foo'])
+        self.assertEqual(d['c:@F@foo']['decl'], 'a.h:1:2')
+        self.assertFalse(d.remove_refs('c:@F@bar', 'a.h'))
+        d.close()
+
+        os.remove(filename)
+
+    def test_usr_lists_interned(self):
+        filename = sys._getframe().f_code.co_name
+        d = SqliteStorage(filename, 'n')
+        d.update({'file_usrs': {'a.h': ['c:@F@foo', 'c:@F@bar']},
+                  'c:@F@foo': {'decl': 'a.h:1:2'}})
+        d.merge({'file_usrs': {'a.h': ['c:@F@bar', 'c:@F@baz'], 'b.h': ['c:@F@foo']}})
+        d.close()
+
+        d = SqliteStorage(filename, 'r')
+        self.assertEqual(d['file_usrs']['a.h'], ['c:@F@foo', 'c:@F@bar', 'c:@F@baz'])
+        self.assertEqual(dict(d['file_usrs']), {'a.h': ['c:@F@foo', 'c:@F@bar', 'c:@F@baz'],
+                                                'b.h': ['c:@F@foo']})
+        # 4 bytes per USR
+        self.assertEqual(d.execute("SELECT LENGTH(data) FROM items WHERE subkey = 'a.h'")
+                         .fetchone()[0], 12)
+        d.close()
+
+        os.remove(filename)
+
+    def test_prefixed_item_keys(self):
+        filename = sys._getframe().f_code.co_name
+        d = SqliteStorage(filename, 'n')
+        d['names'] = dict((name, ['c:@F@' + name]) for name in
+                          ('Ba', 'Bar', 'Base', 'Bb', 'B', 'a\xff', 'a\xff\xff', 'b'))
+        d['other'] = {'Baz': 1}
+        self.assertEqual(d.prefixed_item_keys('names', 'Ba', 10), ['Ba', 'Bar', 'Base'])
+        self.assertEqual(d.prefixed_item_keys('names', 'Ba', 2), ['Ba', 'Bar'])
+        self.assertEqual(d.prefixed_item_keys('names', 'a\xff', 10), ['a\xff', 'a\xff\xff'])
+        self.assertEqual(d.prefixed_item_keys('names', '', 2), ['B', 'Ba'])
+        self.assertEqual(d.prefixed_item_keys('names', 'C', 10), [])
+        self.assertEqual(d.prefixed_item_keys('missing', 'B', 10), [])
+        d.close()
+
+        os.remove(filename)
+
+    def test_old_schema_reset(self):
+        import sqlite3
+        filename = sys._getframe().f_code.co_name
+        conn = sqlite3.connect(filename)
+        conn.execute('CREATE TABLE keys (key TEXT PRIMARY KEY, data BLOB)')
+        conn.commit()
+        conn.close()
+
+        d = SqliteStorage(filename)
+        d['hello'] = 'world'
+        self.assertEqual(d['hello'], 'world')
+        d.close()
+
+        os.remove(filename)
+
+class TestOpenStorage(TestCase):
+    def test_new_is_sqlite(self):
+        filename = sys._getframe().f_code.co_name
+        d = open_storage(filename)
+        self.assertIsInstance(d, SqliteStorage)
+        d.close()
+
+        os.remove(filename)
+
+    def test_shelve_replaced(self):
+        import glob
+        import shelve
+        filename = sys._getframe().f_code.co_name
+        d = shelve.open(filename)
+        d['hello'] = 'world'
+        d.close()
+
+        d = open_storage(filename, 'r')
+        self.assertIsInstance(d, Storage)
+        self.assertEqual(d['hello'], 'world')
+        d.close()
+
+        d = open_storage(filename)
+        self.assertIsInstance(d, SqliteStorage)
+        self.assertNotIn('hello', d)
+        d.close()
+        self.assertEqual(glob.glob(filename + '*'), [filename])
+
+        os.remove(filename)